@@ -1,16 +1,51 @@
 import pathlib
 import tempfile
+import concurrent.futures
+import datetime
+import hashlib
+import json
 import math
 import os
+import struct
 import time
+import urllib.parse
+import numpy as np
 from jinja2 import Environment
-from PIL import Image
+from PIL import Image, ImageOps, features
 from PIL.ExifTags import TAGS
 
 
 PROD_MODE = True
 DELETE_AFTER = 0.1
 MAP_URL = "https://tile.openstreetmap.org/{z}/{x}/{y}.png"
+# Keep the EXIF data read from the images in the media directory, images are only read again when they change
+EXIF_CACHE = True
+EXIF_CACHE_FILE = ".goldencharts_exif.json"
+# Read position and capture time of JPEG images from their headers, other images are opened with PIL
+JPEG_HEADER_READER = True
+# Images are read by this many threads, so slow disks and network shares are read concurrently
+EXIF_WORKERS = 8
+# Place images without GPS position on the track at their capture time. The camera clock is corrected by the
+# given seconds, images taken more than GEOTAG_TOLERANCE seconds away from a GPS fix are not placed
+GEOTAG_BY_TIME = True
+GEOTAG_CAMERA_OFFSET = 0
+GEOTAG_TOLERANCE = 300
+# Show thumbnails in the gallery and popups and only load the original image in the fullscreen view.
+# Thumbnails are scaled so their shorter side has the given sizes, for normal and high density displays
+THUMBNAILS = True
+THUMBNAIL_DIR = ".thumbnails"
+THUMBNAIL_SIZES = (200, 400)
+THUMBNAIL_WORKERS = 4
+THUMBNAIL_FORMAT = "WEBP" if features.check("webp") else "JPEG"
+# Pack the thumbnails of an activity into sprite atlases, so the gallery and popups are shown from a few files.
+# Tiles have the given height, twice the height of the gallery previews, and are cropped to the atlas width
+SPRITES = True
+SPRITE_TILE_HEIGHT = 400
+SPRITE_MAX_WIDTH = 4096
+SPRITE_MAX_HEIGHT = 2000
+# Gallery previews are loaded when they come within this many pixels of the visible area and released again
+# when they leave it
+PRELOAD_MARGIN = 400
 
 LEAFLET_CSS_TAG = """
 <link rel="stylesheet"
@@ -84,17 +119,24 @@ def getDefaultTemplate():
             left: 0;
             z-index: 0;
           }
-          img.previewPlain {
+          img.previewPlain, div.previewPlain {
             width: 200px;
             cursor: pointer;
             border-radius: 10px;
           }
-          img.preview {
+          img.preview, div.preview {
             height: 200px;
             cursor: pointer;
             border-radius: 10px;
             box-shadow: 0px 0px 20px rgba(0, 0, 0, 0.6);
           }
+          div.sprite {
+            background-repeat: no-repeat;
+          }
+          img.lazy:not([src]) {
+            width: 200px;
+            background: var(--colBg);
+          }
           .fullscreen-gallery {
             display: none;
             position: fixed;
@@ -171,7 +213,14 @@ def getDefaultTemplate():
           <div class="fullscreen-gallery-padding">
             <div class="fullscreen-gallery-flex">
             {%- for image in images %}
-              <img class="preview" src="{{ image[0] }}" onclick="openImage({{ loop.index - 1}}, event);"></img>
+            {% if image[4] %}
+              <div class="preview sprite lazy" data-background="{{ image[4][0] }}" style="{{ image[4][1] }}"
+                   onclick="openImage({{ loop.index - 1}}, event);"></div>
+            {% else %}
+              <img class="preview lazy" loading="lazy" data-src="{{ image[3][0] }}"
+                   data-srcset="{{ image[3][0] | replace(' ', '%20') }} 1x, {{ image[3][1] | replace(' ', '%20') }} 2x"
+                   onclick="openImage({{ loop.index - 1}}, event);"></img>
+            {% endif %}
             {% endfor -%}
             </div>
           </div>
@@ -191,6 +240,16 @@ def getDefaultTemplate():
           {%- endfor -%}
           ]).addTo(map);
 
+          const thumbnails = [
+          {%- for image in images -%}
+            ["{{ image[3][0] }}", "{{ image[3][1] }}"],
+          {%- endfor -%}
+          ];
+          const sprites = [
+          {%- for image in images -%}
+            {{ [image[4][0], image[4][2]] | tojson if image[4] else "null" }},
+          {%- endfor -%}
+          ];
           const markers = L.markerClusterGroup();
           const images = [
           {%- for image in images -%}
@@ -202,7 +261,15 @@ def getDefaultTemplate():
               var marker = L.marker(new L.LatLng(item[1], item[2]));
               markers.addLayer(marker);
               item.push(marker);
-              marker.bindPopup(`<img class='previewPlain' src='${item[0]}' id='markerImg' onclick='openImage(${idx}, event);'/>`);
+              if (sprites[idx] != null) {
+                marker.bindPopup(`<div class='previewPlain sprite' `
+                                 + `style='background-image: ${sprites[idx][0]}; ${sprites[idx][1]}' `
+                                 + `id='markerImg' onclick='openImage(${idx}, event);'></div>`);
+              } else {
+                marker.bindPopup(`<img class='previewPlain' src='${thumbnails[idx][0]}' `
+                                 + `srcset='${encodeURI(thumbnails[idx][0])} 1x, ${encodeURI(thumbnails[idx][1])} 2x' `
+                                 + `id='markerImg' onclick='openImage(${idx}, event);'/>`);
+              }
               marker.on('popupopen', function(event) {
                 openPopupIdx = idx;
                 map.keyboard.disable();
@@ -226,6 +293,49 @@ def getDefaultTemplate():
           const fullscreenImageDiv = document.getElementById('fullscreenImage');
           const fullscreenImageImg = document.getElementById('fullscreenImageImg');
           const fullscreenGalleryDiv = document.getElementById('fullscreenGallery');
+          const previews = document.querySelectorAll('.preview.lazy');
+          if ('IntersectionObserver' in window) {
+            // Previews are only decoded while the gallery shows them, hiding the gallery releases all of them
+            const previewObserver = new IntersectionObserver((entries) => {
+              entries.forEach((entry) => {
+                if (entry.isIntersecting) {
+                  loadPreview(entry.target);
+                } else {
+                  releasePreview(entry.target);
+                }
+              });
+            }, {root: document.querySelector('.fullscreen-gallery-padding'), rootMargin: '""" + str(PRELOAD_MARGIN) + """px'});
+            previews.forEach((preview) => previewObserver.observe(preview));
+          } else {
+            previews.forEach(loadPreview);
+          }
+          function loadPreview(preview) {
+            if (preview.dataset.background) {
+              preview.style.backgroundImage = preview.dataset.background;
+            } else if (!preview.hasAttribute('src')) {
+              preview.srcset = preview.dataset.srcset;
+              preview.src = preview.dataset.src;
+            }
+          }
+          function releasePreview(preview) {
+            if (preview.dataset.background) {
+              preview.style.backgroundImage = '';
+            } else if (preview.hasAttribute('src')) {
+              // Keep the width of the loaded preview, so the gallery does not reflow
+              preview.style.width = preview.offsetWidth + 'px';
+              preview.removeAttribute('srcset');
+              preview.removeAttribute('src');
+            }
+          }
+          var prefetchedImages = [];
+          function prefetchImages(idx) {
+            var neighbours = [(idx + 1) % images.length, (idx + images.length - 1) % images.length];
+            prefetchedImages = neighbours.filter((neighbour) => images[neighbour][0] != null).map((neighbour) => {
+              var image = new Image();
+              image.src = images[neighbour][0];
+              return image;
+            });
+          }
           document.addEventListener('keydown', handleKeypress);
           function handleKeypress(event) {
             if (openPageIdx != -1) {
@@ -311,6 +421,7 @@ def getDefaultTemplate():
           }
           function nextImage(event = null) {
             openImage((parseInt(openPageIdx) + 1) % images.length, event);
+            prefetchImages(parseInt(openPageIdx));
           }
           function prevImage(event = null) {
             if (openPageIdx > 0) {
@@ -318,6 +429,7 @@ def getDefaultTemplate():
             } else {
               openImage(images.length - 1, event);
             }
+            prefetchImages(parseInt(openPageIdx));
           }
           function openImage(idx, event = null) {
             images.forEach((item, idx) => {
@@ -352,6 +464,8 @@ def getDefaultTemplate():
             }
           }
           function closeFullscreen() {
+            fullscreenImageImg.src = "";
+            prefetchedImages = [];
             fullscreenImageDiv.style.display = 'none';
             fullscreenGalleryDiv.style.display = 'none';
             openPageIdx = -1;
@@ -394,6 +508,9 @@ def getEmptyTemplate():
     </html>""")
 
 
+EXIF_TIME_FORMAT = "%Y:%m:%d %H:%M:%S"
+
+
 def decimalCoords(coords, ref):
     decimalDegrees = float(coords[0]) + float(coords[1]) / 60 + float(coords[2]) / 3600
     if ref == "S" or ref == 'W':
@@ -404,26 +521,378 @@ def decimalCoords(coords, ref):
 GPSINFO_TAG = next(
     tag for tag, name in TAGS.items() if name == "GPSInfo"
 )
+EXIF_IFD_TAG = next(
+    tag for tag, name in TAGS.items() if name == "ExifOffset"
+)
+DATETIME_TAG = next(
+    tag for tag, name in TAGS.items() if name == "DateTime"
+)
+DATETIME_ORIGINAL_TAG = next(
+    tag for tag, name in TAGS.items() if name == "DateTimeOriginal"
+)
 
-home = GC.athlete()['home']
-mediaDir = home + os.sep + 'media' + os.sep
-imageFiles = []
-for imageName in GC.getTag('Images').split():
-    imageFile = mediaDir + imageName
+
+JPEG_SOI = b"\xff\xd8"
+JPEG_APP1 = 0xe1
+JPEG_SOS = 0xda
+# Start of frame markers hold the image size, 0xc4, 0xc8 and 0xcc share the range but are no frames
+JPEG_SOF_MARKERS = frozenset(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+EXIF_HEADER = b"Exif\x00\x00"
+# Struct format and size of the TIFF field types, ASCII and RATIONAL values are converted afterwards
+TIFF_TYPES = {1: ("B", 1), 2: ("B", 1), 3: ("H", 2), 4: ("I", 4), 5: ("I", 8), 7: ("B", 1), 9: ("i", 4),
+              10: ("i", 8)}
+
+
+def readTiffDirectory(tiff, offset, byteOrder):
+    """
+    Read the entries of a TIFF image file directory
+
+    :return: Dictionary of tag to value. Strings for ASCII entries, tuples for RATIONAL entries and entries with
+             more than one value, numbers otherwise
+    """
+    entries = {}
+    count, = struct.unpack_from(byteOrder + "H", tiff, offset)
+    for i in range(count):
+        tag, fieldType, n, value = struct.unpack_from(byteOrder + "HHI4s", tiff, offset + 2 + 12 * i)
+        if fieldType not in TIFF_TYPES:
+            continue
+        fmt, size = TIFF_TYPES[fieldType]
+        if size * n > 4:
+            valueOffset, = struct.unpack(byteOrder + "I", value)
+            value = tiff[valueOffset:valueOffset + size * n]
+            if len(value) < size * n:
+                continue
+        if fieldType == 2:
+            entries[tag] = value[:n].split(b"\x00", 1)[0].decode("latin-1")
+        elif fieldType in (5, 10):
+            numbers = struct.unpack(byteOrder + fmt * 2 * n, value[:size * n])
+            entries[tag] = tuple(num / den if den != 0 else math.nan for num, den in zip(numbers[::2], numbers[1::2]))
+        else:
+            numbers = struct.unpack(byteOrder + fmt * n, value[:size * n])
+            entries[tag] = numbers[0] if n == 1 else numbers
+    return entries
+
+
+def readJpegInfo(imageFile):
+    """
+    Read position, capture time and dimensions of a JPEG image from its headers, the compressed image data
+    is never read
+
+    :return: Dictionary like readImageInfo, None if the file is no JPEG image or its headers cannot be parsed
+    """
     try:
-        image = Image.open(imageFile)
+        with open(imageFile, "rb") as f:
+            if f.read(2) != JPEG_SOI:
+                return None
+            tiff = None
+            while True:
+                marker, length = struct.unpack(">xBH", f.read(4))
+                if marker == JPEG_APP1 and tiff is None:
+                    segment = f.read(length - 2)
+                    if segment.startswith(EXIF_HEADER):
+                        tiff = segment[len(EXIF_HEADER):]
+                elif marker in JPEG_SOF_MARKERS:
+                    height, width = struct.unpack(">xHH", f.read(5))
+                    break
+                elif marker == JPEG_SOS:
+                    return None
+                else:
+                    f.seek(length - 2, os.SEEK_CUR)
+        info = {'lat': 1000, 'lon': 1000, 'time': None, 'width': width, 'height': height}
+        if tiff is None:
+            return info
+        byteOrder = {b"II": "<", b"MM": ">"}.get(tiff[:2])
+        if byteOrder is None:
+            return None
+        ifd0 = readTiffDirectory(tiff, struct.unpack_from(byteOrder + "I", tiff, 4)[0], byteOrder)
+        exifIfd = readTiffDirectory(tiff, ifd0[EXIF_IFD_TAG], byteOrder) if EXIF_IFD_TAG in ifd0 else {}
+        captureTime = exifIfd.get(DATETIME_ORIGINAL_TAG, ifd0.get(DATETIME_TAG))
+        if captureTime is not None:
+            info['time'] = str(captureTime).strip('\x00 ')
+        try:
+            gpsinfo = readTiffDirectory(tiff, ifd0[GPSINFO_TAG], byteOrder)
+            info['lat'] = decimalCoords(gpsinfo[2], gpsinfo[1])
+            info['lon'] = decimalCoords(gpsinfo[4], gpsinfo[3])
+        except (KeyError, IndexError, TypeError, ValueError):
+            pass
+        return info
+    except (struct.error, TypeError, IndexError, ValueError):
+        # Malformed headers are left to PIL
+        return None
+
+
+def readImageInfo(imageFile):
+    """
+    Read position, capture time and dimensions of an image, the file is closed right after reading
+
+    :return: Dictionary of lat, lon, time, width and height. Images without position get lat and lon 1000
+    """
+    if JPEG_HEADER_READER:
+        info = readJpegInfo(imageFile)
+        if info is not None:
+            return info
+    with Image.open(imageFile) as image:
+        info = {'lat': 1000, 'lon': 1000, 'time': None, 'width': image.width, 'height': image.height}
         exif = image.getexif()
         if exif:
-            gpsinfo = exif.get_ifd(GPSINFO_TAG)
-            imageFiles.append((imageFile,
-                               decimalCoords(gpsinfo[2], gpsinfo[1]),
-                               decimalCoords(gpsinfo[4], gpsinfo[3])))
-        else:
-            imageFiles.append((imageFile, 1000, 1000))
-    except KeyError:
-        imageFiles.append((imageFile, 1000, 1000))
+            captureTime = exif.get_ifd(EXIF_IFD_TAG).get(DATETIME_ORIGINAL_TAG, exif.get(DATETIME_TAG))
+            if captureTime is not None:
+                info['time'] = str(captureTime).strip('\x00 ')
+            try:
+                gpsinfo = exif.get_ifd(GPSINFO_TAG)
+                info['lat'] = decimalCoords(gpsinfo[2], gpsinfo[1])
+                info['lon'] = decimalCoords(gpsinfo[4], gpsinfo[3])
+            except (KeyError, IndexError, TypeError, ValueError):
+                pass
+    return info
+
+
+def loadExifCache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def saveExifCache(path, cache):
+    try:
+        with open(path + ".tmp", "w") as f:
+            json.dump(cache, f)
+        os.replace(path + ".tmp", path)
+    except IOError:
+        print("Cannot write exif cache '%s'" % path)
+
+
+def geotagByTime(imageFiles, captureTimes, activityStart, seconds, lats, lons):
+    """
+    Place images without position on the track at their capture time. All images are interpolated
+    between the GPS fixes around them with one sorted search
+
+    :return: Image files with the interpolated positions, images outside the track keep lat and lon 1000
+    """
+    offsets = np.full(len(imageFiles), np.nan)
+    for i, ((_, lat, lon), captureTime) in enumerate(zip(imageFiles, captureTimes)):
+        if lat < 999 and lon < 999 or captureTime is None:
+            continue
+        try:
+            captureTime = datetime.datetime.strptime(captureTime, EXIF_TIME_FORMAT)
+        except ValueError:
+            continue
+        offsets[i] = (captureTime - activityStart).total_seconds() + GEOTAG_CAMERA_OFFSET
+    seconds = np.asarray(seconds, dtype=float)
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    # Samples without GPS fix have both coordinates at 0
+    fixes = (lats != 0) | (lons != 0)
+    seconds, lats, lons = seconds[fixes], lats[fixes], lons[fixes]
+    if len(seconds) < 2 or np.isnan(offsets).all():
+        return imageFiles
+    after = np.clip(np.searchsorted(seconds, offsets), 1, len(seconds) - 1)
+    before = after - 1
+    span = seconds[after] - seconds[before]
+    weight = np.clip((offsets - seconds[before]) / np.where(span > 0, span, 1), 0, 1)
+    gap = np.minimum(np.abs(offsets - seconds[before]), np.abs(offsets - seconds[after]))
+    imageLats = lats[before] + weight * (lats[after] - lats[before])
+    imageLons = lons[before] + weight * (lons[after] - lons[before])
+    placed = gap <= GEOTAG_TOLERANCE
+    return [(imageFile, float(imageLats[i]), float(imageLons[i])) if placed[i] else (imageFile, lat, lon)
+            for i, (imageFile, lat, lon) in enumerate(imageFiles)]
+
+
+def thumbnailPaths(imageName):
+    base = mediaDir + THUMBNAIL_DIR + os.sep + imageName
+    return [base + "_%d.%s" % (size, THUMBNAIL_FORMAT.lower()) for size in THUMBNAIL_SIZES]
+
+
+def createThumbnails(imageFile, paths):
+    """
+    Write the thumbnails of an image, thumbnails newer than the image are kept
+
+    :return: Paths of the thumbnails, the image itself if the thumbnails could not be written
+    """
+    try:
+        mtime = os.stat(imageFile).st_mtime_ns
+        if all(os.path.exists(path) and os.stat(path).st_mtime_ns >= mtime for path in paths):
+            return paths
+        os.makedirs(os.path.dirname(paths[0]), exist_ok=True)
+        with Image.open(imageFile) as image:
+            # Let the JPEG decoder scale down right away, the orientation does not change the shorter side
+            scale = max(THUMBNAIL_SIZES) / min(image.size)
+            image.draft("RGB", (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ("RGB", "RGBA") or THUMBNAIL_FORMAT == "JPEG":
+                image = image.convert("RGB")
+            for path, size in zip(paths, THUMBNAIL_SIZES):
+                scale = size / min(image.size)
+                thumbnail = image
+                if scale < 1:
+                    thumbnail = image.resize((round(image.width * scale), round(image.height * scale)),
+                                             Image.LANCZOS)
+                thumbnail.save(path + ".tmp", format=THUMBNAIL_FORMAT)
+                os.replace(path + ".tmp", path)
+        return paths
+    except Exception:
+        # Runs in a worker thread, an error of one image must not abort the gallery
+        print("Cannot create thumbnails of image '%s'" % imageFile)
+        return [imageFile] * len(paths)
+
+
+def createSprites(thumbnailFiles, basePath):
+    """
+    Pack thumbnails into sprite atlases row by row. The atlases and their table are written next to the
+    thumbnails and only written again when a thumbnail or the list of thumbnails changes
+
+    :return: Tuple of atlas path, x, y, width, height, atlas width and atlas height per thumbnail,
+             None if the atlases cannot be written
+    """
+    tablePath = basePath + ".json"
+    try:
+        fingerprint = [[path, os.stat(path).st_mtime_ns] for path in thumbnailFiles]
+        fingerprint.append([SPRITE_TILE_HEIGHT, SPRITE_MAX_WIDTH, SPRITE_MAX_HEIGHT, THUMBNAIL_FORMAT])
+    except IOError:
+        return None
+    oldAtlases = []
+    try:
+        with open(tablePath) as f:
+            table = json.load(f)
+        oldAtlases = table['atlases']
+        if table['fingerprint'] == fingerprint and all(os.path.exists(path) for path in oldAtlases):
+            return [tuple(tile) for tile in table['tiles']]
+    except (IOError, ValueError, KeyError):
+        pass
+    try:
+        # Lay out the tiles in rows, an atlas is full when the next row does not fit anymore
+        layout = []
+        atlasSizes = [[0, SPRITE_TILE_HEIGHT]]
+        x = 0
+        for path in thumbnailFiles:
+            with Image.open(path) as thumbnail:
+                # Even widths keep the tiles on whole pixels in the previews of half the height
+                width = min(2 * round(thumbnail.width * SPRITE_TILE_HEIGHT / thumbnail.height / 2), SPRITE_MAX_WIDTH)
+            if x + width > SPRITE_MAX_WIDTH:
+                x = 0
+                if atlasSizes[-1][1] + SPRITE_TILE_HEIGHT > SPRITE_MAX_HEIGHT:
+                    atlasSizes.append([0, SPRITE_TILE_HEIGHT])
+                else:
+                    atlasSizes[-1][1] += SPRITE_TILE_HEIGHT
+            layout.append((len(atlasSizes) - 1, x, atlasSizes[-1][1] - SPRITE_TILE_HEIGHT, width))
+            x += width
+            atlasSizes[-1][0] = max(atlasSizes[-1][0], x)
+        key = hashlib.sha1(json.dumps(fingerprint).encode()).hexdigest()[:12]
+        atlases = [basePath + "_%s_%d.%s" % (key, i, THUMBNAIL_FORMAT.lower()) for i in range(len(atlasSizes))]
+        for atlasIndex, (atlasPath, atlasSize) in enumerate(zip(atlases, atlasSizes)):
+            atlas = Image.new("RGB", tuple(atlasSize))
+            for path, (index, x, y, width) in zip(thumbnailFiles, layout):
+                if index != atlasIndex:
+                    continue
+                with Image.open(path) as thumbnail:
+                    atlas.paste(ImageOps.fit(thumbnail.convert("RGB"), (width, SPRITE_TILE_HEIGHT), Image.LANCZOS),
+                                (x, y))
+            atlas.save(atlasPath + ".tmp", format=THUMBNAIL_FORMAT)
+            os.replace(atlasPath + ".tmp", atlasPath)
+        tiles = [(atlases[index], x, y, width, SPRITE_TILE_HEIGHT) + tuple(atlasSizes[index])
+                 for index, x, y, width in layout]
+        with open(tablePath + ".tmp", "w") as f:
+            json.dump({'fingerprint': fingerprint, 'atlases': atlases, 'tiles': tiles}, f)
+        os.replace(tablePath + ".tmp", tablePath)
     except IOError:
+        print("Cannot create sprites '%s'" % basePath)
+        return None
+    for path in oldAtlases:
+        if path not in atlases:
+            try:
+                os.unlink(path)
+            except IOError:
+                pass
+    return tiles
+
+
+def spriteStyle(tile, scale):
+    """
+    CSS of an element showing a tile of a sprite atlas scaled by the given factor, the atlas itself is set
+    as background image when the element is shown
+
+    :return: Style attribute value
+    """
+    _, x, y, width, height, atlasWidth, atlasHeight = tile
+    return ("background-position: %gpx %gpx; background-size: %gpx %gpx; width: %gpx; height: %gpx;"
+            % (-x * scale, -y * scale, atlasWidth * scale, atlasHeight * scale, width * scale, height * scale))
+
+
+def loadImageInfo(imageName):
+    """
+    Load the info of an image from the cache or read it if the image changed.
+    Runs in a worker thread and only reads the cache
+
+    :return: Info of the image, whether it was read, or None if the image cannot be read.
+             Any error reading one image only skips that image, it must not abort the gallery
+    """
+    imageFile = mediaDir + imageName
+    try:
+        stat = os.stat(imageFile)
+        info = exifCache.get(imageName)
+        # An image is identified by its path, size and modification time
+        if info is not None and info['size'] == stat.st_size and info['mtime'] == stat.st_mtime_ns:
+            return info, False
+        info = readImageInfo(imageFile)
+        info['size'] = stat.st_size
+        info['mtime'] = stat.st_mtime_ns
+        return info, True
+    except Exception:
         print("Cannot read exif info from image '%s'" % imageFile)
+        return None, False
+
+
+home = GC.athlete()['home']
+mediaDir = home + os.sep + 'media' + os.sep
+exifCachePath = mediaDir + EXIF_CACHE_FILE
+exifCache = loadExifCache(exifCachePath) if EXIF_CACHE else {}
+exifCacheChanged = False
+imageNames = GC.getTag('Images').split()
+imageFiles = []
+captureTimes = []
+# map keeps the order of the Images tag
+with concurrent.futures.ThreadPoolExecutor(max_workers=EXIF_WORKERS) as executor:
+    for imageName, (info, isRead) in zip(imageNames, executor.map(loadImageInfo, imageNames)):
+        if info is None:
+            continue
+        if isRead:
+            exifCache[imageName] = info
+            exifCacheChanged = True
+        imageFiles.append((mediaDir + imageName, info['lat'], info['lon']))
+        captureTimes.append(info['time'])
+if EXIF_CACHE and exifCacheChanged:
+    # The cache covers the images of all activities, drop the images deleted since
+    exifCache = {name: info for name, info in exifCache.items() if os.path.exists(mediaDir + name)}
+    saveExifCache(exifCachePath, exifCache)
+
+lats = GC.series(GC.SERIES_LAT)
+lons = GC.series(GC.SERIES_LON)
+metrics = GC.activityMetrics()
+activityStart = datetime.datetime.combine(metrics['date'], metrics['time'])
+if GEOTAG_BY_TIME and imageFiles:
+    imageFiles = geotagByTime(imageFiles, captureTimes, activityStart, GC.series(GC.SERIES_SECS), lats, lons)
+
+if THUMBNAILS:
+    # Decoding, scaling and encoding release the GIL, so threads create thumbnails in parallel
+    with concurrent.futures.ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS) as executor:
+        thumbnails = list(executor.map(createThumbnails,
+                                       [imageFile for imageFile, _, _ in imageFiles],
+                                       [thumbnailPaths(imageFile[len(mediaDir):]) for imageFile, _, _ in imageFiles]))
+else:
+    thumbnails = [[imageFile] * len(THUMBNAIL_SIZES) for imageFile, _, _ in imageFiles]
+sprites = [None] * len(imageFiles)
+# Sprites are made of the largest thumbnails, so only when all thumbnails exist
+if (THUMBNAILS and SPRITES and imageFiles
+        and all(paths[-1] != imageFile for (imageFile, _, _), paths in zip(imageFiles, thumbnails))):
+    tiles = createSprites([paths[-1] for paths in thumbnails],
+                          mediaDir + THUMBNAIL_DIR + os.sep + activityStart.strftime("sprite_%Y%m%d_%H%M%S"))
+    if tiles is not None:
+        # Gallery previews have the height and popups the width of the smallest thumbnails
+        sprites = [("url(%s)" % urllib.parse.quote(tile[0]), spriteStyle(tile, THUMBNAIL_SIZES[0] / tile[4]),
+                    spriteStyle(tile, THUMBNAIL_SIZES[0] / tile[3])) for tile in tiles]
+imageFiles = [imageFile + (tuple(paths), sprite) for imageFile, paths, sprite in zip(imageFiles, thumbnails, sprites)]
 
 if PROD_MODE:
     outFile = tempfile.NamedTemporaryFile(mode="w+t", prefix="GC_", suffix=".html", delete=False)
@@ -432,8 +901,6 @@ else:
 outPath = pathlib.Path(outFile.name)
 
 track = []
-lats = GC.series(GC.SERIES_LAT)
-lons = GC.series(GC.SERIES_LON)
 maxI = len(lats)
 for i in range(maxI):
     lat = lats[i]
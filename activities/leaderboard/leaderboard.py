@@ -2,14 +2,32 @@
 
 import pandas
 import numpy as np
+import contextlib
+import cProfile
+import functools
+import hashlib
+import itertools
+import json
+import operator
+import os
 import pathlib
+import pstats
+import shutil
+import sqlite3
 import tempfile
 import time
 import traceback
+import tracemalloc
 from jinja2 import Environment
 from jinja2.filters import pass_environment
 from datetime import date, datetime, timedelta
-from collections import OrderedDict
+
+try:
+    import pyarrow.compute
+    import pyarrow.feather
+    CACHE_SUFFIX = ".feather"
+except ImportError:
+    CACHE_SUFFIX = ".pkl"
 
 
 MAP_PROVIDER = "https://tile.openstreetmap.org/{z}/{x}/{y}.png"
@@ -18,6 +36,48 @@ MAP_ATTRIBUTION = '&copy; <a href="https://www.openstreetmap.org/copyright">Open
 TRACE_COLOR = "purple"
 
 DATE_FORMAT = "%d.%m.%Y"
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# Keep the route segment intervals of a season on disk and only add new activities on later runs
+SEASON_CACHE = True
+CACHE_DIR = "goldencharts"
+# Match the season intervals against the segments of the activity in blocks of this many rows,
+# only the matching rows are ever put into a DataFrame
+SEASON_CHUNK_ROWS = 100000
+# Rank each attempt against all activities, not only against the selected season
+ALL_TIME_INDEX = True
+ALL_TIME_TOP_K = 3
+# Embed the leaderboards as compact data and build tables and maps only when a segment is opened
+LAZY_RENDER = True
+# Only show the fastest attempts, the current attempt with its neighbours and the slowest attempt.
+# Further attempts are loaded page by page on request, 0 shows all attempts
+LEADERBOARD_TOP_N = 10
+LEADERBOARD_NEIGHBOURS = 2
+LEADERBOARD_PAGE_SIZE = 25
+# Chart duration, running personal best and the mean duration of the preceding days for each segment
+PROGRESSION_CHART = True
+PROGRESSION_WINDOW_DAYS = 30
+# Chart the time gap of the current attempt to the fastest other attempt along the segment distance
+BEST_COMPARISON = True
+BEST_COMPARISON_POINTS = 200
+# Keep the rendered page of each activity and show it again as long as nothing it depends on changed
+STORE_PAGES = True
+# Render the pages of all activities in the season whose segment attempts changed before showing the current one
+PRERENDER_SEASON = False
+# Detect segments by matching stretches of the activity against the GPS tracks of the season
+# when the activity has no route segments. Lengths and widths are in meters
+AUTO_SEGMENTS = True
+AUTO_TYPE_NAME = "Detected"
+AUTO_SEGMENT_LENGTH = 2000
+AUTO_SAMPLE_SPACING = 20
+AUTO_GATE_WIDTH = 25
+AUTO_DISTANCE_TOLERANCE = 0.1
+# Write a JSON report with timings and row counts of each stage next to the rendered page
+PROFILE_REPORT = False
+# Set these environment variables to "1" to include a cProfile summary or the traced memory peak of each stage
+PROFILE_CPROFILE_ENV = "GOLDENCHARTS_CPROFILE"
+PROFILE_TRACEMALLOC_ENV = "GOLDENCHARTS_TRACEMALLOC"
+PROFILE_TOP_FUNCTIONS = 30
 
 BOOTSTRAP_CSS_TAG = """
 <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.2.3/dist/css/bootstrap.min.css"
@@ -48,13 +108,38 @@ LEAFLET_JS_TAG = """
 
 COMMON_KEYS = ["name", "Distance", "Elevation_Gain", "Elevation_Loss", "Duration", "Average_Power",
                "Average_Heart_Rate", "Average_Speed", "Average_Cadence", "BikeStress", "VAM"]
+INFO_KEYS = ["Distance", "Elevation_Gain", "Elevation_Loss"]
+AVERAGE_KEYS = ["Duration", "Average_Power", "Average_Heart_Rate", "Average_Speed", "Average_Cadence", "BikeStress"]
+BOARD_KEYS = ["rank", "Duration", "Average_Power", "Average_Heart_Rate", "Average_Speed", "Average_Cadence",
+              "BikeStress", "VAM", "isCurrent", "deltaDuration", "deltaPercent"]
+PACKED_KEYS = ["start", "Duration", "deltaDuration", "deltaPercent", "Average_Power", "Average_Heart_Rate",
+               "Average_Speed", "Average_Cadence", "BikeStress", "VAM", "isCurrent"]
+# Metrics where 0 means "not recorded", excluded from averages
+ZERO_AS_MISSING_KEYS = ["Average_Heart_Rate", "Average_Power", "Average_Cadence", "BikeStress"]
 
 
 def main():
-    st = time.time()
+    if PRERENDER_SEASON:
+        try:
+            prerenderSeason()
+        except Exception:
+            traceback.print_exc()
+
+    profiler = StageProfiler()
     failed = False
+    page = None
     try:
-        segments, info = collectData()
+        with profiler.stage('retrieveData') as stage:
+            data = retrieveData()
+            stage['rows'] = len(data[0]['name'])
+        if STORE_PAGES:
+            page = currentPage(*data)
+            if page is not None and isPageFresh(*page):
+                profiler.stop()
+                print("Showing stored page")
+                GC.webpage(page[0].as_uri())
+                return
+        segments, info = collectData(profiler, data)
     except MissingSeasonError:
         failed = True
         msg = 'Failed to load route segments'
@@ -75,25 +160,251 @@ def main():
         msg = 'Failed to load segments'
         resolution = ''
         trace = traceback.format_exc()
-    et = time.time()
-    print("Dataprocessing took {:.3f} seconds".format(et-st))
 
     outFile = tempfile.NamedTemporaryFile(mode="w+t", prefix="GC_", suffix=".html", delete=False)
+    try:
+        if not failed:
+            with profiler.stage('render') as stage:
+                renderLeaderboard(outFile.name, segments, info)
+                stage['rows'] = len(segments['data'])
+            if page is not None:
+                storePage(*page, outFile.name)
+        else:
+            template = createEnvironment().from_string(getErrorTemplate())
+            template.stream(msg=msg, resolution=resolution, trace=trace).dump(outFile.name)
+    finally:
+        profiler.stop()
+    if PROFILE_REPORT:
+        try:
+            profiler.writeReport(pathlib.Path(outFile.name).with_suffix('.json'), failed)
+        except Exception:
+            traceback.print_exc()
+
+    GC.webpage(pathlib.Path(outFile.name).as_uri())
+
+
+def createEnvironment():
     env = Environment()
     env.filters['duration'] = duration
     env.filters['format_date'] = format_date
     env.filters['show'] = show
     env.trim_blocks = True
     env.lstrip_blocks = True
+    return env
 
-    if not failed:
-        template = env.from_string(getDefaultTemplate())
-        template.stream(segments=segments, info=info).dump(outFile.name)
-    else:
-        template = env.from_string(getErrorTemplate())
-        template.stream(msg=msg, resolution=resolution, trace=trace).dump(outFile.name)
 
-    GC.webpage(pathlib.Path(outFile.name).as_uri())
+def renderLeaderboard(path, segments, info):
+    template = createEnvironment().from_string(getDefaultTemplate())
+    template.stream(segments=segments,
+                    info=info,
+                    lazy=LAZY_RENDER,
+                    packed=LAZY_RENDER or LEADERBOARD_TOP_N > 0,
+                    progression=PROGRESSION_CHART,
+                    comparison=BEST_COMPARISON).dump(str(path))
+
+
+def pagePaths(activityStart):
+    pagesDir = cacheDir() / 'pages'
+    pagesDir.mkdir(exist_ok=True)
+    name = "leaderboard_" + activityStart.strftime("%Y%m%d_%H%M%S")
+    return pagesDir / (name + ".html"), pagesDir / (name + ".json")
+
+
+def pageFingerprint(activitySeason, info, activityStart, modified, segmentNames, seasonAttempts, allTimeAttempts):
+    """
+    Fingerprint everything a stored page depends on: the season, the activity itself and its modification time,
+    the attempts of its segments in the season and of all time, and the page settings.
+    Activities without attempts of these segments leave the page fresh
+    """
+    digest = hashlib.sha1(seasonKey(activitySeason, info['intervalType']).encode('utf-8'))
+    digest.update("{}|{}|{}|{}|{}".format(activityStart.isoformat(), modified, info['Route'],
+                                          info['outOfSeason'], info['autoDetected']).encode('utf-8'))
+    for name in sorted(set(segmentNames)):
+        digest.update("{}|{}|{}".format(name, seasonAttempts.get(name), allTimeAttempts.get(name)).encode('utf-8'))
+    digest.update(repr((LAZY_RENDER, LEADERBOARD_TOP_N, LEADERBOARD_NEIGHBOURS, LEADERBOARD_PAGE_SIZE,
+                        PROGRESSION_CHART, PROGRESSION_WINDOW_DAYS, BEST_COMPARISON, BEST_COMPARISON_POINTS,
+                        ALL_TIME_INDEX, ALL_TIME_TOP_K, AUTO_SEGMENTS, AUTO_SEGMENT_LENGTH, AUTO_SAMPLE_SPACING,
+                        AUTO_GATE_WIDTH, AUTO_DISTANCE_TOLERANCE)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def currentPage(trendIntervals, activity, activityIntervals, activityMetrics, activitySeason, info):
+    """
+    Fingerprint the page of the current activity from its retrieved data, the all-time index is brought up to date
+
+    :return: Paths of the stored page of the current activity and its metadata,
+             and the fingerprint the stored page must have to be shown. None if the page cannot be fingerprinted
+    """
+    try:
+        activityStart = datetime.combine(activityMetrics['date'], activityMetrics['time'])
+        segmentNames = list(set(activityIntervals['name']))
+        activities = seasonActivities(activitySeason)
+        seasonIntervalsDF = seasonIntervalsTable(trendIntervals)
+        seasonIntervalsDF = seasonIntervalsDF[seasonIntervalsDF['name'].isin(segmentNames)]
+        seasonAttempts = attemptFingerprints(seasonIntervalsDF, activities, activitiesModified(activities))
+        allTimeAttempts = dict()
+        if ALL_TIME_INDEX and not info['autoDetected']:
+            connection = openAttemptIndex(attemptIndexPath(info['intervalType']))
+            try:
+                updateAttemptIndex(connection, info['intervalType'], (activityStart, activityIntervals))
+                allTimeAttempts = allTimeFingerprints(connection, segmentNames)
+            finally:
+                connection.close()
+        pagePath, metaPath = pagePaths(activityStart)
+        fingerprint = pageFingerprint(activitySeason, info, activityStart,
+                                      activitiesModified([activityStart])[activityStart.isoformat()],
+                                      segmentNames, seasonAttempts, allTimeAttempts)
+        return pagePath, metaPath, fingerprint
+    except Exception:
+        traceback.print_exc()
+        return None
+
+
+def attemptFingerprints(seasonIntervalsDF, activities, modified):
+    """
+    Fingerprint the attempts of each segment together with the modification time of the activity of each attempt,
+    the order of the attempts does not matter
+
+    :return: Dictionary of segment name to fingerprint
+    """
+    activityKeys = startKeys([a.date() for a in activities], [a.time() for a in activities])
+    owners = np.searchsorted(activityKeys, seasonIntervalsDF['start'].to_numpy(), side='right') - 1
+    # Attempts before the first activity get the modification time 0, the last entry
+    activityModified = np.array([modified[a.isoformat()] for a in activities] + [0], dtype=np.int64)
+    attemptsDF = seasonIntervalsDF.drop(columns='name').astype(float)
+    attemptsDF['modified'] = activityModified[owners]
+    hashes = pandas.DataFrame({'name': seasonIntervalsDF['name'].astype(str).to_numpy(),
+                               'hash': pandas.util.hash_pandas_object(attemptsDF, index=False).to_numpy()})
+    grouped = hashes.sort_values(['name', 'hash']).groupby('name', sort=False)['hash']
+    return {name: hashlib.sha1(group.to_numpy().tobytes()).hexdigest() for name, group in grouped}
+
+
+def allTimeFingerprints(connection, segmentNames=None):
+    """
+    Fingerprint the all-time attempts of each segment, of the given segments only if any
+
+    :return: Dictionary of segment name to fingerprint
+    """
+    query = "SELECT name, start, duration FROM attempts"
+    parameters = []
+    if segmentNames is not None:
+        query += " WHERE name IN ({})".format(", ".join("?" * len(segmentNames)))
+        parameters = segmentNames
+    fingerprints = dict()
+    rows = connection.execute(query + " ORDER BY name, start, duration", parameters)
+    for name, attempts in itertools.groupby(rows, key=operator.itemgetter(0)):
+        digest = hashlib.sha1()
+        for _, start, duration in attempts:
+            digest.update("{}|{}".format(start, duration).encode('utf-8'))
+        fingerprints[name] = digest.hexdigest()
+    return fingerprints
+
+
+def isPageFresh(pagePath, metaPath, fingerprint):
+    if not pagePath.exists() or not metaPath.exists():
+        return False
+    return json.loads(metaPath.read_text())['fingerprint'] == fingerprint
+
+
+def storePage(pagePath, metaPath, fingerprint, renderedPath):
+    try:
+        shutil.copyfile(renderedPath, pagePath)
+        metaPath.write_text(json.dumps({'fingerprint': fingerprint}))
+    except Exception:
+        traceback.print_exc()
+
+
+def prerenderSeason():
+    """
+    Render and store the pages of all activities of the selected season.
+    Pages are rendered one after another in this process, since forking the GoldenCheetah process is unsafe.
+    The season intervals are loaded once and each page is keyed on the attempts of its segments,
+    so only pages whose segment attempts changed are computed again
+    """
+    st = time.time()
+    activitySeason = GC.season()
+    typeName = GC.intervalType(type=6)
+    seasonIntervalsDF = seasonIntervalsTable(retrieveTrendIntervals(activitySeason, typeName))
+    activities = seasonActivities(activitySeason)
+    modified = activitiesModified(activities)
+    seasonAttempts = attemptFingerprints(seasonIntervalsDF, activities, modified)
+    # The segments of each activity are those of the season intervals started during the activity
+    activityKeys = startKeys([a.date() for a in activities], [a.time() for a in activities])
+    owners = np.searchsorted(activityKeys, seasonIntervalsDF['start'].to_numpy(), side='right') - 1
+    activitySegments = seasonIntervalsDF['name'].astype(str).groupby(owners).unique()
+    seasonMetrics = GC.seasonMetrics()
+    routes = dict(zip((datetime.combine(d, t) for d, t in zip(seasonMetrics['date'], seasonMetrics['time'])),
+                      seasonMetrics.get('Route', itertools.repeat(''))))
+    references = comparisonReferences() if BEST_COMPARISON else None
+
+    connection = openAttemptIndex(attemptIndexPath(typeName)) if ALL_TIME_INDEX else None
+    rendered = 0
+    try:
+        allTimeAttempts = dict()
+        if connection is not None:
+            updateAttemptIndex(connection, typeName)
+            allTimeAttempts = allTimeFingerprints(connection)
+        for i, activityStart in enumerate(activities):
+            if i not in activitySegments.index:
+                continue
+            info = dict()
+            info['outOfSeason'] = False
+            info['Route'] = routes.get(activityStart, '')
+            info['date'] = activityStart.date()
+            info['seasonName'] = activitySeason['name'][0]
+            info['intervalType'] = typeName
+            info['autoDetected'] = False
+            pagePath, metaPath = pagePaths(activityStart)
+            fingerprint = pageFingerprint(activitySeason, info, activityStart, modified[activityStart.isoformat()],
+                                          activitySegments[i], seasonAttempts, allTimeAttempts)
+            if isPageFresh(pagePath, metaPath, fingerprint):
+                continue
+            if renderActivityPage(seasonIntervalsDF, activityStart, info, connection, references, pagePath):
+                metaPath.write_text(json.dumps({'fingerprint': fingerprint}))
+                rendered += 1
+    finally:
+        if connection is not None:
+            connection.close()
+    et = time.time()
+    print("Prerendering {} pages took {:.3f} seconds".format(rendered, et-st))
+
+
+def renderActivityPage(seasonIntervalsDF, activityStart, info, connection, references, pagePath):
+    """
+    Compute and render the page of one activity against the keyed season intervals,
+    like the page of the current activity
+
+    :return: True if the page was rendered
+    """
+    try:
+        activityIntervals = reduceActivityIntervals(GC.activityIntervals(type=info['intervalType'],
+                                                                         activity=activityStart))
+        activity = retrieveActivitySeries(activityStart)
+        traces = findTraces(np.asarray(activityIntervals['start'], dtype=float),
+                            np.asarray(activityIntervals['stop'], dtype=float),
+                            activity)
+        activityIntervalsDF, segmentNames = prepareActivityIntervals(activityIntervals, activityStart, traces)
+        matchingIntervalsDF = seasonIntervalsDF[seasonIntervalsDF['name'].isin(segmentNames.categories)].copy()
+        matchingIntervalsDF['name'] = matchingIntervalsDF['name'].astype(str).astype(segmentNames)
+        matchingIntervalsDF, segmentNamesAttempts = mergeIntervals(matchingIntervalsDF, activityIntervalsDF)
+        segments = findSegments(segmentNamesAttempts, matchingIntervalsDF)
+        if connection is not None:
+            rankAllTime(connection, segments)
+        if references is not None:
+            addBestComparisons(segments, activity, activityStart, references, seriesActivity=activityStart)
+        if LAZY_RENDER or LEADERBOARD_TOP_N > 0:
+            packSegments(segments)
+        if PROGRESSION_CHART:
+            packProgressions(segments)
+        if references is not None:
+            packComparisons(segments)
+        renderLeaderboard(pagePath,
+                          {'overview': createSegmentsOverview(segments, None), 'data': segments},
+                          info)
+        return True
+    except Exception:
+        traceback.print_exc()
+        return False
 
 
 @pass_environment
@@ -141,6 +452,98 @@ class NoActivitySegmentsError(Exception):
         self.info = info
 
 
+class StageProfiler:
+    """
+    Records wall-clock time, row counts and, if tracing, peak memory per processing stage.
+    cProfile and tracemalloc are only enabled through their environment variables and with the report.
+    GoldenCheetah reuses the interpreter for later charts, so both are stopped again with the profiler
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.start = time.time()
+        self.seconds = None
+        self.tracing = PROFILE_REPORT and os.environ.get(PROFILE_TRACEMALLOC_ENV) == "1"
+        self.startedTracing = self.tracing and not tracemalloc.is_tracing()
+        self.profile = None
+        if self.startedTracing:
+            tracemalloc.start()
+        if PROFILE_REPORT and os.environ.get(PROFILE_CPROFILE_ENV) == "1":
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time the enclosed block, the yielded dict takes the number of rows processed
+        """
+        record = {'name': name, 'rows': None}
+        baseline = self.resetPeak()
+        st = time.time()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.time() - st
+            record['peakMemory'] = self.peakMemory(baseline)
+            self.stages.append(record)
+            print("{} took {:.3f} seconds".format(name, record['seconds']))
+
+    def resetPeak(self):
+        """
+        Reset the traced memory peak at the start of a stage
+
+        :return: Traced bytes the peak of the stage is measured from, None if not tracing
+        """
+        if not self.tracing:
+            return None
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.clear_traces()
+        return tracemalloc.get_traced_memory()[0]
+
+    def peakMemory(self, baseline):
+        """
+        :return: Peak traced bytes allocated during the stage, None if not tracing
+        """
+        if baseline is None:
+            return None
+        return tracemalloc.get_traced_memory()[1] - baseline
+
+    def stop(self):
+        self.seconds = time.time() - self.start
+        if self.profile is not None:
+            self.profile.disable()
+        if self.startedTracing and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def writeReport(self, path, failed):
+        report = {
+            'generated': datetime.now().isoformat(timespec='seconds'),
+            'failed': failed,
+            'seconds': self.seconds,
+            'stages': self.stages,
+            'settings': {
+                'SEASON_CACHE': SEASON_CACHE,
+                'ALL_TIME_INDEX': ALL_TIME_INDEX,
+                'LAZY_RENDER': LAZY_RENDER,
+                'LEADERBOARD_TOP_N': LEADERBOARD_TOP_N,
+                'CACHE_SUFFIX': CACHE_SUFFIX
+            }
+        }
+        if self.profile is not None:
+            stats = pstats.Stats(self.profile)
+            functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+            report['cProfile'] = [{
+                'function': "{}:{}({})".format(*function),
+                'calls': calls,
+                'totalSeconds': totalTime,
+                'cumulativeSeconds': cumulativeTime
+            } for function, (_, calls, totalTime, cumulativeTime, _) in functions[:PROFILE_TOP_FUNCTIONS]]
+        path.write_text(json.dumps(report, indent=2))
+        print("Profile report written to {}".format(path))
+
+
 def retrieveData():
     try:
         activitySeason = GC.season()
@@ -149,38 +552,563 @@ def retrieveData():
     seasonStart = activitySeason['start'][0]
     seasonEnd = activitySeason['end'][0]
     am = GC.activityMetrics()
+    typeName = GC.intervalType(type=6)
     info = dict()
     info['outOfSeason'] = False
     info['Route'] = am.get('Route', '')
     info['date'] = am['date']
     info['seasonName'] = activitySeason['name'][0]
+    info['intervalType'] = typeName
+    info['autoDetected'] = False
     activityStart = datetime.combine(am['date'], am['time'])
     activityEnd = activityStart + timedelta(seconds=am['Duration'])
-    typeName = GC.intervalType(type=6)
+    if activityStart.date() < seasonStart or activityEnd.date() > seasonEnd:
+        info['outOfSeason'] = True
     activityIntervals = reduceActivityIntervals(GC.activityIntervals(type=typeName))
     if len(activityIntervals['start']) == 0:
-        raise NoActivitySegmentsError(activityStart=activityStart, info=info)
-
-    trendIntervals = reduceTrendIntervals(GC.seasonIntervals(type=typeName))
-    if activityStart.date() < seasonStart or activityEnd.date() > seasonEnd:
+        if not AUTO_SEGMENTS:
+            raise NoActivitySegmentsError(activityStart=activityStart, info=info)
+        activity = retrieveActivitySeries()
+        trendIntervals, activityIntervals = detectSegments(activitySeason, activityStart, activity)
+        if len(activityIntervals['start']) == 0:
+            raise NoActivitySegmentsError(activityStart=activityStart, info=info)
+        info['intervalType'] = AUTO_TYPE_NAME
+        info['autoDetected'] = True
+        return trendIntervals, activity, activityIntervals, am, activitySeason, info
+
+    segmentNames = pandas.unique(pandas.Series(activityIntervals['name'], dtype=object)).tolist()
+    trendIntervals = retrieveTrendIntervals(activitySeason, typeName, segmentNames)
+    if info['outOfSeason']:
         trendIntervals = extendWithActivityIntervals(trendIntervals, activityStart, activityIntervals)
-        info['outOfSeason'] = True
+    elif SEASON_CACHE and not containsActivityIntervals(trendIntervals, activityStart, activityIntervals):
+        # The intervals of the activity changed without the activity file, e.g. for a new route segment
+        print("Season cache is missing intervals of the activity, retrieving the season again")
+        trendIntervals = retrieveTrendIntervals(activitySeason, typeName, segmentNames, refresh=True)
+
+    activity = retrieveActivitySeries()
+    return trendIntervals, activity, activityIntervals, am, activitySeason, info
+
+
+def retrieveActivitySeries(activity=None):
+    """
+    Retrieve only the data series of the activity needed for the segment traces,
+    instead of every series GC.activity() would materialize
+    """
+    return {
+        'seconds': GC.series(GC.SERIES_SECS, activity=activity),
+        'latitude': GC.series(GC.SERIES_LAT, activity=activity),
+        'longitude': GC.series(GC.SERIES_LON, activity=activity)
+    }
 
-    activity = GC.activity()
-    activityMetrics = GC.activityMetrics()
-    return trendIntervals, activity, activityIntervals, activityMetrics, activitySeason, info
+
+def retrieveTrendIntervals(activitySeason, typeName, segmentNames=None, refresh=False):
+    """
+    Retrieve the reduced trend intervals of the season, using the on-disk cache if enabled.
+    The cache is keyed by season and interval type and records the activities it holds
+    with the modification time of their files. Intervals of activities added since the last run
+    are appended, if activities were removed or changed the whole season is retrieved again.
+    An added activity with a segment unknown to the cache also retrieves the whole season,
+    since GoldenCheetah adds the intervals of a new route segment to older activities without changing their files.
+    With segment names given, the cached season is filtered to these segments before it is turned into lists
+
+    :return: Reduced trend intervals as returned by reduceTrendIntervals
+    """
+    if not SEASON_CACHE:
+        return reduceTrendIntervals(GC.seasonIntervals(type=typeName))
+
+    activities = seasonActivities(activitySeason)
+    modified = activitiesModified(activities)
+    fingerprint = modifiedFingerprint(modified)
+    dataPath, metaPath = seasonCachePaths(activitySeason, typeName)
+
+    trendIntervalsDF = None
+    try:
+        if not refresh and dataPath.exists() and metaPath.exists():
+            meta = json.loads(metaPath.read_text())
+            if meta['fingerprint'] == fingerprint:
+                return readTrendIntervals(dataPath, segmentNames).to_dict('list')
+            cached = meta['activities']
+            if isinstance(cached, dict) and all(modified.get(a) == m for a, m in cached.items()):
+                added = {key: [] for key in ["date", "time"] + COMMON_KEYS}
+                for activityStart in activities:
+                    if activityStart.isoformat() not in cached:
+                        activityIntervals = reduceActivityIntervals(GC.activityIntervals(type=typeName,
+                                                                                         activity=activityStart))
+                        added = extendWithActivityIntervals(added, activityStart, activityIntervals)
+                trendIntervalsDF = readTrendIntervals(dataPath)
+                if not set(added['name']).issubset(trendIntervalsDF['name'].unique()):
+                    print("New segments in the added activities, retrieving the season again")
+                    trendIntervalsDF = None
+                elif len(added['name']) > 0:
+                    trendIntervalsDF = pandas.concat([trendIntervalsDF, pandas.DataFrame(added)], ignore_index=True)
+    except Exception:
+        traceback.print_exc()
+        trendIntervalsDF = None
+
+    if trendIntervalsDF is None:
+        trendIntervalsDF = pandas.DataFrame(reduceTrendIntervals(GC.seasonIntervals(type=typeName)))
+    try:
+        writeTrendIntervals(dataPath, trendIntervalsDF)
+        metaPath.write_text(json.dumps({'fingerprint': fingerprint, 'activities': modified}))
+    except Exception:
+        traceback.print_exc()
+    if segmentNames is not None:
+        trendIntervalsDF = trendIntervalsDF[trendIntervalsDF['name'].isin(segmentNames)]
+    return trendIntervalsDF.to_dict('list')
+
+
+def containsActivityIntervals(trendIntervals, activityStart, activityIntervals):
+    """
+    Check that every interval of the activity is in the trend intervals, keyed by segment name and start
+
+    :return: True if no interval of the activity is missing
+    """
+    segmentNames = pandas.CategoricalDtype(pandas.unique(pandas.Series(activityIntervals['name'], dtype=object)))
+    rows = matchingRows(trendIntervals['name'], segmentNames)
+    seasonKeys = set(zip(takeRows(trendIntervals['name'], rows),
+                         startKeys(takeRows(trendIntervals['date'], rows),
+                                   takeRows(trendIntervals['time'], rows)).tolist()))
+    activityKey = int(startKeys([activityStart.date()], [activityStart.time()])[0])
+    return all((name, activityKey + int(start)) in seasonKeys
+               for name, start in zip(activityIntervals['name'], activityIntervals['start']))
+
+
+def activitiesModified(activities):
+    """
+    :return: Dictionary of the activity starts in ISO format to the modification time in nanoseconds
+             of the file GoldenCheetah keeps the activity in, 0 if the file cannot be found
+    """
+    activitiesDir = pathlib.Path(GC.athlete()['home']) / 'activities'
+    modified = dict()
+    for activity in activities:
+        try:
+            modified[activity.isoformat()] = (activitiesDir
+                                              / activity.strftime("%Y_%m_%d_%H_%M_%S.json")).stat().st_mtime_ns
+        except OSError:
+            modified[activity.isoformat()] = 0
+    return modified
+
+
+def modifiedFingerprint(modified):
+    digest = hashlib.sha1()
+    for activity, mtime in sorted(modified.items()):
+        digest.update("{}|{}".format(activity, mtime).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def seasonActivities(activitySeason):
+    seasonStart = activitySeason['start'][0]
+    seasonEnd = activitySeason['end'][0]
+    return sorted(GC.activities('Date >= "%s" and Date <= "%s"' % (seasonStart.strftime("%Y/%m/%d"),
+                                                                 seasonEnd.strftime("%Y/%m/%d"))))
+
+
+def seasonKey(activitySeason, typeName):
+    return "{}|{}|{}|{}".format(activitySeason['name'][0],
+                                activitySeason['start'][0],
+                                activitySeason['end'][0],
+                                typeName)
+
+
+def seasonCachePaths(activitySeason, typeName):
+    name = "leaderboard_" + hashlib.sha1(seasonKey(activitySeason, typeName).encode('utf-8')).hexdigest()
+    return cacheDir() / (name + CACHE_SUFFIX), cacheDir() / (name + ".json")
+
+
+def cacheDir():
+    path = pathlib.Path(GC.athlete()['home']) / 'cache' / CACHE_DIR
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def readTrendIntervals(path, segmentNames=None):
+    """
+    Read the cached trend intervals, only the rows of the given segment names if any.
+    Feather files are filtered by pyarrow before the rows are converted to pandas
+
+    :return: DataFrame of the trend intervals
+    """
+    if CACHE_SUFFIX == ".feather":
+        table = pyarrow.feather.read_table(path)
+        if segmentNames is not None:
+            table = table.filter(pyarrow.compute.is_in(table['name'],
+                                                       value_set=pyarrow.array(segmentNames,
+                                                                               type=table.schema.field('name').type)))
+        return table.to_pandas()
+    trendIntervalsDF = pandas.read_pickle(path)
+    if segmentNames is not None:
+        trendIntervalsDF = trendIntervalsDF[trendIntervalsDF['name'].isin(segmentNames)]
+    return trendIntervalsDF
+
+
+def writeTrendIntervals(path, trendIntervalsDF):
+    tmpPath = path.with_name(path.name + ".tmp")
+    if CACHE_SUFFIX == ".feather":
+        trendIntervalsDF.to_feather(tmpPath)
+    else:
+        trendIntervalsDF.to_pickle(tmpPath)
+    tmpPath.replace(path)
+
+
+def attemptIndexPath(typeName):
+    name = "attempts_" + hashlib.sha1(typeName.encode('utf-8')).hexdigest()
+    return cacheDir() / (name + ".sqlite")
+
+
+def openAttemptIndex(path):
+    """
+    Open the all-time index of segment attempts.
+    Attempts are indexed by (name, duration) so ranks and top attempts are range queries
+
+    :return: sqlite3 connection to the index
+    """
+    connection = sqlite3.connect(str(path))
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS activities (activity TEXT PRIMARY KEY, modified INTEGER);
+        CREATE TABLE IF NOT EXISTS attempts (activity TEXT NOT NULL,
+                                             name TEXT NOT NULL,
+                                             start TEXT NOT NULL,
+                                             duration REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS attemptsByDuration ON attempts (name, duration);
+        CREATE INDEX IF NOT EXISTS attemptsByActivity ON attempts (activity);
+    """)
+    # Indexes written before the modification times were recorded are re-indexed
+    if 'modified' not in [row[1] for row in connection.execute("PRAGMA table_info(activities)")]:
+        with connection:
+            connection.execute("ALTER TABLE activities ADD COLUMN modified INTEGER")
+    return connection
+
+
+def updateAttemptIndex(connection, typeName, current=None):
+    """
+    Bring the attempt index up to date with the activities known to GoldenCheetah.
+    Activities added or modified since the last update are read, removed activities are dropped.
+    The attempts of the current activity, given as start and intervals, are compared with the index
+    and re-indexed if they changed. A segment unknown to the index in any activity read re-indexes
+    all activities, since a new route segment is added to the intervals of old rides without changing their files
+    """
+    activities = sorted(GC.activities())
+    modified = activitiesModified(activities)
+    indexed = dict(connection.execute("SELECT activity, modified FROM activities"))
+    knownNames = set(row[0] for row in connection.execute("SELECT DISTINCT name FROM attempts"))
+    with connection:
+        for activity in indexed.keys() - modified.keys():
+            connection.execute("DELETE FROM attempts WHERE activity = ?", (activity,))
+            connection.execute("DELETE FROM activities WHERE activity = ?", (activity,))
+    stale = [activityStart for activityStart in activities
+             if indexed.get(activityStart.isoformat(), -1) != modified[activityStart.isoformat()]]
+    intervalsByActivity = dict()
+    if current is not None and current[0].isoformat() in modified:
+        activityStart, intervals = current
+        intervalsByActivity[activityStart] = intervals
+        if activityStart not in stale:
+            indexedAttempts = sorted(connection.execute("SELECT * FROM attempts WHERE activity = ?",
+                                                        (activityStart.isoformat(),)))
+            if sorted(activityAttempts(activityStart, intervals)) != indexedAttempts:
+                stale.append(activityStart)
+    # An empty index reads all activities anyway
+    if len(knownNames) > 0:
+        for activityStart in stale:
+            if activityStart not in intervalsByActivity:
+                intervalsByActivity[activityStart] = GC.activityIntervals(type=typeName, activity=activityStart)
+        if not all(knownNames.issuperset(intervalsByActivity[activityStart]['name']) for activityStart in stale):
+            print("New segments in the activities, rebuilding the attempt index")
+            stale = activities
+    for activityStart in stale:
+        intervals = intervalsByActivity.get(activityStart)
+        if intervals is None:
+            intervals = GC.activityIntervals(type=typeName, activity=activityStart)
+        with connection:
+            connection.execute("DELETE FROM attempts WHERE activity = ?", (activityStart.isoformat(),))
+            connection.executemany("INSERT INTO attempts VALUES (?, ?, ?, ?)",
+                                   activityAttempts(activityStart, intervals))
+            connection.execute("INSERT OR REPLACE INTO activities VALUES (?, ?)",
+                               (activityStart.isoformat(), modified[activityStart.isoformat()]))
+
+
+def activityAttempts(activityStart, intervals):
+    """
+    :return: Rows of the attempt index for the intervals of an activity
+    """
+    return [(activityStart.isoformat(),
+             str(name),
+             (activityStart + timedelta(seconds=float(start))).isoformat(),
+             float(duration))
+            for name, start, duration in zip(intervals['name'], intervals['start'], intervals['Duration'])]
+
+
+def attemptRank(connection, name, duration):
+    """
+    :return: Rank of an attempt with the given duration and the number of attempts of the segment
+    """
+    faster = connection.execute("SELECT COUNT(*) FROM attempts WHERE name = ? AND duration < ?",
+                                (name, duration)).fetchone()[0]
+    total = connection.execute("SELECT COUNT(*) FROM attempts WHERE name = ?", (name,)).fetchone()[0]
+    return faster + 1, total
+
+
+def topAttempts(connection, name, k):
+    """
+    :return: The k fastest attempts of the segment
+    """
+    rows = connection.execute("SELECT start, duration FROM attempts WHERE name = ? ORDER BY duration LIMIT ?",
+                              (name, k))
+    return [{'start': datetime.fromisoformat(start), 'Duration': duration} for start, duration in rows]
+
+
+def addAllTimeRanks(segments, typeName, current):
+    connection = openAttemptIndex(attemptIndexPath(typeName))
+    try:
+        updateAttemptIndex(connection, typeName, current)
+        rankAllTime(connection, segments)
+    finally:
+        connection.close()
+
+
+def rankAllTime(connection, segments):
+    for segment in segments:
+        segment['allTimeRank'], segment['allTimeAttempts'] = attemptRank(connection,
+                                                                         segment['name'],
+                                                                         segment['currentDuration'])
+        segment['allTimeTop'] = topAttempts(connection, segment['name'], ALL_TIME_TOP_K)
+
+
+def detectSegments(activitySeason, activityStart, activity):
+    """
+    Detect stretches of the activity that were ridden again in the season.
+    The activity is cut into stretches of AUTO_SEGMENT_LENGTH between gates. The simplified tracks
+    of the season are put into a grid index so only track points near a gate are tested for crossing it,
+    an attempt is a crossing of a start gate followed by the end gate after about the same distance
+
+    :return: Trend intervals and activity intervals of the detected segments with at least two attempts
+    """
+    activities = seasonActivities(activitySeason)
+    if activityStart not in activities:
+        activities.append(activityStart)
+    currentTrack = simplifyTrack(activity)
+    tracks = [currentTrack if a == activityStart else seasonTrack(a) for a in activities]
+    current = activities.index(activityStart)
+
+    trendIntervals = {key: [] for key in ["date", "time"] + COMMON_KEYS}
+    activityIntervals = {key: [] for key in ["start", "stop"] + COMMON_KEYS}
+    if len(currentTrack) < 2:
+        return trendIntervals, activityIntervals
+
+    origin = np.radians(currentTrack[:, 1:].mean(axis=0))
+    points = [trackPoints(track, origin) for track in tracks]
+    gateDistances, gates, headings = findGates(points[current])
+    if len(gateDistances) < 2:
+        return trendIntervals, activityIntervals
+
+    owners = np.repeat(np.arange(len(points)), [len(p) for p in points])
+    points = np.concatenate(points)
+    gate, crossingActivity, crossingTime, crossingDistance = findCrossings(points, owners, gates, headings)
+
+    seconds = np.asarray(activity['seconds'], dtype=float)
+    altitude = np.asarray(GC.series(GC.SERIES_ALT), dtype=float)
+    for i in range(len(gateDistances) - 1):
+        isStart = gate == i
+        isEnd = gate == i + 1
+        owner, start, stop, distance = matchAttempts(crossingActivity[isStart], crossingTime[isStart],
+                                                     crossingDistance[isStart], crossingActivity[isEnd],
+                                                     crossingTime[isEnd], crossingDistance[isEnd])
+        isCurrent = owner == current
+        if len(owner) < 2 or not isCurrent.any():
+            continue
+        name = "{} {:.1f}-{:.1f} km".format(AUTO_TYPE_NAME, gateDistances[i] / 1000, gateDistances[i + 1] / 1000)
+        indices = secsToIndices(np.array([start[isCurrent][0], stop[isCurrent][0]]), seconds)
+        climb = np.diff(altitude[indices[0]:indices[1] + 1])
+        gain = climb[climb > 0].sum()
+        loss = -climb[climb < 0].sum()
+        for a, t0, t1, d in zip(owner, start, stop, distance):
+            duration = t1 - t0
+            values = {
+                "name": name,
+                "Distance": d / 1000,
+                "Elevation_Gain": gain,
+                "Elevation_Loss": loss,
+                "Duration": duration,
+                "Average_Power": 0.0,
+                "Average_Heart_Rate": 0.0,
+                "Average_Speed": d / duration * 3.6,
+                "Average_Cadence": 0.0,
+                "BikeStress": 0.0,
+                "VAM": gain / duration * 3600
+            }
+            dt = activities[a] + timedelta(seconds=t0)
+            trendIntervals['date'].append(dt.date())
+            trendIntervals['time'].append(dt.time())
+            for key in COMMON_KEYS:
+                trendIntervals[key].append(values[key])
+            if a == current:
+                activityIntervals['start'].append(t0)
+                activityIntervals['stop'].append(t1)
+                for key in COMMON_KEYS:
+                    activityIntervals[key].append(values[key])
+    return trendIntervals, activityIntervals
+
+
+def seasonTrack(activityStart):
+    """
+    Retrieve the simplified track of an activity, simplified tracks are kept on disk
+    so only activities new to the season have to be loaded
+
+    :return: (n, 3) array of seconds, latitude and longitude
+    """
+    tracksDir = cacheDir() / 'tracks'
+    tracksDir.mkdir(exist_ok=True)
+    path = tracksDir / "{}_{}.npy".format(activityStart.strftime("%Y%m%d_%H%M%S"), AUTO_SAMPLE_SPACING)
+    try:
+        return np.load(str(path))
+    except Exception:
+        pass
+    track = simplifyTrack(retrieveActivitySeries(activityStart))
+    try:
+        np.save(str(path), track)
+    except Exception:
+        traceback.print_exc()
+    return track
+
+
+def simplifyTrack(activity):
+    """
+    Resample the track to about one point per AUTO_SAMPLE_SPACING, samples without position are dropped
+
+    :return: (n, 3) array of seconds, latitude and longitude
+    """
+    track = np.column_stack((np.asarray(activity['seconds'], dtype=float),
+                             np.asarray(activity['latitude'], dtype=float),
+                             np.asarray(activity['longitude'], dtype=float)))
+    track = track[(track[:, 1] != 0) | (track[:, 2] != 0)]
+    if len(track) < 2:
+        return np.empty((0, 3))
+    distance = trackPoints(track, np.radians(track[:, 1:].mean(axis=0)))[:, 3]
+    keep = np.diff(np.floor(distance / AUTO_SAMPLE_SPACING), prepend=-1) > 0
+    keep[-1] = True
+    return track[keep]
+
+
+def projectTrack(track, origin):
+    """
+    Project latitude/longitude to meters with an equirectangular projection around origin
+
+    :return: (n, 2) array of x and y
+    """
+    radians = np.radians(track[:, 1:])
+    return np.column_stack(((radians[:, 1] - origin[1]) * np.cos(origin[0]) * 6371000,
+                            (radians[:, 0] - origin[0]) * 6371000))
+
+
+def trackPoints(track, origin):
+    """
+    :return: (n, 4) array of x, y, seconds and distance along the track
+    """
+    xy = projectTrack(track, origin)
+    distance = np.concatenate(([0], np.cumsum(np.hypot(*np.diff(xy, axis=0).T))))[:len(xy)]
+    return np.column_stack((xy, track[:, 0], distance))
+
+
+def findGates(points):
+    """
+    Place gates every AUTO_SEGMENT_LENGTH along the track, each facing the direction of travel
+
+    :return: Distance of each gate along the track, gate positions and unit headings
+    """
+    distance = points[:, 3]
+    gateDistances = np.arange(AUTO_SAMPLE_SPACING, distance[-1] - AUTO_SAMPLE_SPACING, AUTO_SEGMENT_LENGTH)
+
+    def position(d):
+        return np.column_stack((np.interp(d, distance, points[:, 0]), np.interp(d, distance, points[:, 1])))
+
+    gates = position(gateDistances)
+    headings = position(gateDistances + AUTO_SAMPLE_SPACING) - position(gateDistances - AUTO_SAMPLE_SPACING)
+    norms = np.hypot(headings[:, 0], headings[:, 1])
+    isValid = norms > 0
+    headings = headings[isValid] / norms[isValid, np.newaxis]
+    return gateDistances[isValid], gates[isValid], headings
+
+
+def findCrossings(points, owners, gates, headings):
+    """
+    Find all crossings of the gates in the direction of their heading.
+    Track points are sorted into grid cells of the gate width plus the sample spacing,
+    so every step crossing a gate has a point in the 3x3 cells around the gate
+
+    :return: Gate, activity, time and distance along the track of each crossing
+    """
+    cellSize = AUTO_GATE_WIDTH + AUTO_SAMPLE_SPACING
+    cells = np.floor(points[:, :2] / cellSize).astype(np.int64)
+    keys = cells[:, 0] * 2 ** 32 + cells[:, 1]
+    order = np.argsort(keys, kind='stable')
+    sortedKeys = keys[order]
+
+    gateCells = np.floor(gates / cellSize).astype(np.int64)
+    dx, dy = np.meshgrid([-1, 0, 1], [-1, 0, 1])
+    queryKeys = ((gateCells[:, 0, np.newaxis] + dx.ravel()) * 2 ** 32
+                 + gateCells[:, 1, np.newaxis] + dy.ravel()).ravel()
+    lo = np.searchsorted(sortedKeys, queryKeys, side='left')
+    counts = np.searchsorted(sortedKeys, queryKeys, side='right') - lo
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    candidates = order[np.repeat(lo, counts) + offsets]
+    candidateGates = np.repeat(np.repeat(np.arange(len(gates)), 9), counts)
+
+    # Test the steps before and after each candidate point, once per gate
+    steps = np.concatenate((candidates - 1, candidates))
+    stepGates = np.concatenate((candidateGates, candidateGates))
+    isStep = (steps >= 0) & (steps < len(points) - 1)
+    steps, stepGates = steps[isStep], stepGates[isStep]
+    isStep = owners[steps] == owners[steps + 1]
+    stepGates, steps = np.divmod(np.unique(stepGates[isStep] * len(points) + steps[isStep]), len(points))
+
+    heading = headings[stepGates]
+    before = points[steps, :2] - gates[stepGates]
+    after = points[steps + 1, :2] - gates[stepGates]
+    s0 = (before * heading).sum(axis=1)
+    s1 = (after * heading).sum(axis=1)
+    isCrossing = (s0 < 0) & (s1 >= 0)
+    fraction = -s0[isCrossing] / (s1[isCrossing] - s0[isCrossing])
+    steps, stepGates, heading = steps[isCrossing], stepGates[isCrossing], heading[isCrossing]
+    crossing = before[isCrossing] + fraction[:, np.newaxis] * (after[isCrossing] - before[isCrossing])
+    isInGate = np.abs(crossing[:, 1] * heading[:, 0] - crossing[:, 0] * heading[:, 1]) <= AUTO_GATE_WIDTH
+    steps, stepGates, fraction = steps[isInGate], stepGates[isInGate], fraction[isInGate]
+    times = points[steps, 2] + fraction * (points[steps + 1, 2] - points[steps, 2])
+    distances = points[steps, 3] + fraction * (points[steps + 1, 3] - points[steps, 3])
+    return stepGates, owners[steps], times, distances
+
+
+def matchAttempts(startActivity, startTime, startDistance, endActivity, endTime, endDistance):
+    """
+    Pair each start gate crossing with the next end gate crossing of the same activity.
+    Only pairs about AUTO_SEGMENT_LENGTH apart along the track are attempts,
+    of several starts before the same end the last one is used
+
+    :return: Activity, start and stop time and distance of each attempt
+    """
+    if len(startTime) == 0 or len(endTime) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0), np.empty(0)
+    startOrder = np.lexsort((startTime, startActivity))
+    startActivity, startTime, startDistance = (startActivity[startOrder], startTime[startOrder],
+                                               startDistance[startOrder])
+    endOrder = np.lexsort((endTime, endActivity))
+    endActivity, endTime, endDistance = endActivity[endOrder], endTime[endOrder], endDistance[endOrder]
+
+    # Crossing times are compared within each activity by offsetting them per activity
+    span = max(startTime.max(), endTime.max()) + 1
+    ends = np.searchsorted(endActivity * span + endTime, startActivity * span + startTime, side='right')
+    ends = np.minimum(ends, len(endTime) - 1)
+    distance = endDistance[ends] - startDistance
+    isMatched = (endActivity[ends] == startActivity) & (endTime[ends] > startTime)
+    isMatched &= np.abs(distance - AUTO_SEGMENT_LENGTH) <= AUTO_DISTANCE_TOLERANCE * AUTO_SEGMENT_LENGTH
+    matched = np.flatnonzero(isMatched)
+    # Starts are sorted, keep the last one before each end
+    matched = matched[np.append(ends[matched][1:] != ends[matched][:-1], True)]
+    return startActivity[matched], startTime[matched], endTime[ends[matched]], distance[matched]
 
 
 def extendWithActivityIntervals(trendIntervals, activityStart, activityIntervals):
-    i = len(trendIntervals['date'])
-    s = len(activityIntervals['start'])
-    trendIntervals['date'].extend([None] * s)
-    trendIntervals['time'].extend([None] * s)
-    for s in activityIntervals['start']:
-        dt = activityStart + timedelta(seconds=s)
-        trendIntervals['date'][i] = dt.date()
-        trendIntervals['time'][i] = dt.time()
-        i += 1
+    starts = [activityStart + timedelta(seconds=s) for s in activityIntervals['start']]
+    trendIntervals['date'].extend([dt.date() for dt in starts])
+    trendIntervals['time'].extend([dt.time() for dt in starts])
     for key in COMMON_KEYS:
         trendIntervals[key].extend(activityIntervals[key])
     return trendIntervals
@@ -204,148 +1132,538 @@ def reduceTrendIntervals(intervals):
     return newIntervals
 
 
-def secsToIndex(sec, secs):
+def secsToIndices(secs, seconds):
+    """
+    Find the indices of all secs in seconds with a single sorted search.
+    This method can be used to find the indices of segments within the activity
+
+    :return: Index of each given time, 0 for times after the end of the activity
+    """
+    indices = np.searchsorted(seconds, secs, side='left')
+    indices[indices == len(seconds)] = 0
+    return indices
+
+
+def findTraces(starts, stops, activity):
+    """
+    Find the traces of all intervals given by starts and stops.
+    The activity series are converted to arrays once, each trace is a view into them
+
+    :return: Array holding one (n, 2) array of latitude/longitude pairs per interval
+    """
+    seconds = np.asarray(activity['seconds'], dtype=float)
+    points = np.column_stack((np.asarray(activity['latitude'], dtype=float),
+                              np.asarray(activity['longitude'], dtype=float)))
+    numIntervals = len(starts)
+    indices = secsToIndices(np.concatenate((starts, stops)), seconds)
+    traces = np.empty(numIntervals, dtype=object)
+    for i, (istart, iend) in enumerate(zip(indices[:numIntervals], indices[numIntervals:])):
+        traces[i] = points[istart:iend + 1]
+    return traces
+
+
+def startKeys(dates, times):
     """
-    Find the index of sec in secs.
-    This method can be used to find the index of a segment within thw
+    Combine date and time of day columns into int64 seconds since the epoch.
+    The key replaces the date/time object columns when joining intervals
 
-    :return: Index of the given time
+    :return: Array of start keys
     """
-    for i, s in enumerate(secs):
-        if s >= sec:
-            return i
-    return 0
+    days = np.fromiter((d.toordinal() for d in dates), dtype=np.int64, count=len(dates))
+    secs = np.fromiter((t.hour * 3600 + t.minute * 60 + t.second for t in times), dtype=np.int64, count=len(times))
+    return (days - EPOCH_ORDINAL) * 86400 + secs
 
 
-def findTrace(start, end, activity):
-    istart = secsToIndex(start, activity['seconds'])
-    iend = secsToIndex(end, activity['seconds'])
-    trace = []
-    for i in range(istart, iend + 1):
-        trace.append((activity['latitude'][i], activity['longitude'][i]))
-    return trace
+def keysToDateTimes(keys):
+    return pandas.to_datetime(pandas.Series(keys), unit='s')
 
 
 def prepareData(trendIntervals, activityIntervals, activityMetrics, activitySeason, activity):
-    trendIntervalsDF = pandas.DataFrame(trendIntervals)
+    traces = findTraces(np.asarray(activityIntervals['start'], dtype=float),
+                        np.asarray(activityIntervals['stop'], dtype=float),
+                        activity)
+    activityStart = datetime.combine(activityMetrics['date'], activityMetrics['time'])
+    activityIntervalsDF, segmentNames = prepareActivityIntervals(activityIntervals, activityStart, traces)
+
+    matching = matchingRows(trendIntervals['name'], segmentNames)
+    matchingIntervalsDF = pandas.DataFrame({key: takeRows(trendIntervals[key], matching) for key in COMMON_KEYS})
+    matchingIntervalsDF['name'] = matchingIntervalsDF['name'].astype(segmentNames)
+    matchingIntervalsDF.insert(1, 'start', startKeys(takeRows(trendIntervals['date'], matching),
+                                                     takeRows(trendIntervals['time'], matching)))
+
+    return mergeIntervals(matchingIntervalsDF, activityIntervalsDF)
+
+
+def matchingRows(names, segmentNames):
+    """
+    Find the rows of segments ridden in the activity, SEASON_CHUNK_ROWS names at a time.
+    Names not in the categories get the code -1
+
+    :return: Indices of the matching rows
+    """
+    chunkRows = SEASON_CHUNK_ROWS if SEASON_CHUNK_ROWS > 0 else max(len(names), 1)
+    matching = [np.flatnonzero(pandas.Categorical(names[i:i + chunkRows], dtype=segmentNames).codes >= 0) + i
+                for i in range(0, len(names), chunkRows)]
+    return np.concatenate(matching) if len(matching) > 0 else np.empty(0, dtype=np.int64)
+
+
+def takeRows(column, rows):
+    """
+    :return: Sequence of the given rows of a column list, the column itself if all rows are taken
+    """
+    if len(rows) == len(column):
+        return column
+    if len(rows) == 0:
+        return []
+    if len(rows) == 1:
+        return [column[rows[0]]]
+    return operator.itemgetter(*rows)(column)
+
+
+def prepareActivityIntervals(activityIntervals, activityStart, traces):
+    """
+    :return: The intervals of the activity keyed by segment name and start,
+             and the categorical type of the segment names
+    """
     activityIntervalsDF = pandas.DataFrame(activityIntervals)
+    activityIntervalsDF['trace'] = traces
+    segmentNames = pandas.CategoricalDtype(activityIntervalsDF['name'].unique())
+    activityIntervalsDF['name'] = activityIntervalsDF['name'].astype(segmentNames)
+    activityIntervalsDF['start'] = (startKeys([activityStart.date()], [activityStart.time()])[0]
+                                    + activityIntervalsDF['start'].to_numpy().astype(np.int64))
+    return activityIntervalsDF[['name', 'start', 'trace']], segmentNames
 
-    activityIntervalsDF['trace'] = activityIntervalsDF.apply(lambda row: findTrace(row['start'],
-                                                                                   row['stop'],
-                                                                                   activity), axis=1)
-    matchingIntervalsDF = trendIntervalsDF[trendIntervalsDF['name'].isin(activityIntervalsDF['name'])]
-    activityStart = datetime.combine(activityMetrics['date'], activityMetrics['time'])
-    activityIntervalsDF['datetime'] = pandas.to_datetime(activityStart
-                                                         + pandas.to_timedelta(activityIntervalsDF['start'], unit='s'))
-    activityIntervalsDF['date'] = pandas.to_datetime(activityIntervalsDF['datetime']).dt.date
-    activityIntervalsDF['time'] = pandas.to_datetime(activityIntervalsDF['datetime']).dt.time
-    activityIntervalsDF['isCurrent'] = True
-    activityIntervalsDF = activityIntervalsDF[['name', 'date', 'time', 'isCurrent', 'trace']]
 
+def seasonIntervalsTable(trendIntervals):
+    """
+    Build the keyed table of all season intervals once, to be matched against many activities
+    """
+    seasonIntervalsDF = pandas.DataFrame({key: trendIntervals[key] for key in COMMON_KEYS})
+    seasonIntervalsDF['name'] = seasonIntervalsDF['name'].astype('category')
+    seasonIntervalsDF.insert(1, 'start', startKeys(trendIntervals['date'], trendIntervals['time']))
+    return seasonIntervalsDF
+
+
+def mergeIntervals(matchingIntervalsDF, activityIntervalsDF):
     matchingIntervalsDF = pandas.merge(matchingIntervalsDF,
                                        activityIntervalsDF,
                                        how='left',
-                                       left_on=['name', 'date', 'time'],
-                                       right_on=['name', 'date', 'time'])
-    matchingIntervalsDF['isCurrent'] = matchingIntervalsDF['isCurrent'].fillna(False)
+                                       on=['name', 'start'],
+                                       indicator='isCurrent')
+    matchingIntervalsDF['isCurrent'] = matchingIntervalsDF['isCurrent'] == 'both'
     segmentNamesAttempts = matchingIntervalsDF['name'].value_counts()
+    segmentNamesAttempts = segmentNamesAttempts[segmentNamesAttempts > 0]
 
     return matchingIntervalsDF, segmentNamesAttempts
 
 
-def createSegmentsOverview(segmentNamesAttempts, activitySeason):
+def createSegmentsOverview(segments, activitySeason):
     segmentsOverview = dict()
 
-    segmentsOverview['numSegments'] = len(segmentNamesAttempts)
+    # Only the segments found with a current attempt are rendered and counted
+    segmentsOverview['numSegments'] = len(segments)
 
     return segmentsOverview
 
 
 def segmentTrace(start, stop, activity):
-    startIdx = secsToIndex(start, activity['seconds'])
-    stopIdx = secsToIndex(stop, activity['seconds'])
-    trace = []
+    startIdx, stopIdx = secsToIndices(np.array([start, stop], dtype=float),
+                                      np.asarray(activity['seconds'], dtype=float))
     if startIdx > 0 and stopIdx > 0:
-        for i in range(startIdx, stopIdx + 1):
-            trace.append((activity['latitudes'][i], activity['longitudes'][i]))
-    return trace
+        return findTraces([start], [stop], activity)[0]
+    return np.empty((0, 2))
+
+
+def visibleRanges(visible):
+    """
+    Find the runs of visible attempts on a leaderboard.
+
+    :return: List of [from, to) index ranges
+    """
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], visible.astype(np.int8), [0]))))
+    return edges.reshape(-1, 2).tolist()
 
 
 def findSegments(segmentNamesAttempts, matchingIntervalsDF):
-    segmentsDict = dict()
-
-    for name, attempts in segmentNamesAttempts.sort_values(axis=0, ascending=False).items():
-        segmentDF = matchingIntervalsDF[matchingIntervalsDF.name == name].copy()
-        segmentDF['Average_Heart_Rate'].replace(0.0, np.NaN, inplace=True)
-        segmentDF['Average_Power'].replace(0.0, np.NaN, inplace=True)
-        segmentDF['Average_Cadence'].replace(0.0, np.NaN, inplace=True)
-        segmentDF['BikeStress'].replace(0.0, np.NaN, inplace=True)
-        segmentInfoSeries = segmentDF[['Distance',
-                                       'Elevation_Gain',
-                                       'Elevation_Loss']].mean()
-        segmentAvgSeries = segmentDF[['Duration',
-                                      'Average_Power',
-                                      'Average_Heart_Rate',
-                                      'Average_Speed',
-                                      'Average_Cadence',
-                                      'BikeStress']].mean()
-        segmentBoardDF = segmentDF[['date',
-                                    'time',
-                                    'Duration',
-                                    'Average_Power',
-                                    'Average_Heart_Rate',
-                                    'Average_Speed',
-                                    'Average_Cadence',
-                                    'BikeStress',
-                                    'VAM',
-                                    'isCurrent']].sort_values(by='Duration', ignore_index=True)
-        current = segmentDF.loc[segmentDF['isCurrent'] == True, ['date', 'time', 'trace']].iloc[0]
-        currentDateTime = datetime.combine(current['date'], current['time'])
-        durationDF = segmentBoardDF['Duration']
-        minDuration = durationDF.min()
-        maxDuration = durationDF.max()
-        segmentBoardDF['deltaDuration'] = (segmentBoardDF['Duration'] - minDuration)
-        segmentBoardDF['deltaPercent'] = 100 * segmentBoardDF['deltaDuration'] / minDuration
+    segmentDF = matchingIntervalsDF.sort_values(by=['name', 'Duration'], kind='stable')
+    segmentDF[ZERO_AS_MISSING_KEYS] = segmentDF[ZERO_AS_MISSING_KEYS].replace(0.0, np.nan)
+    segmentDF['hasHeartRate'] = segmentDF['Average_Heart_Rate'] > 0.0
+    segmentDF['hasCadence'] = segmentDF['Average_Cadence'] > 0.0
+    segmentDF['hasPower'] = segmentDF['Average_Power'] > 0.0
+
+    grouped = segmentDF.groupby('name', sort=True, observed=True)
+    minDuration = grouped['Duration'].transform('min')
+    segmentDF['rank'] = grouped.cumcount() + 1
+    segmentDF['currentRank'] = segmentDF['rank'].where(segmentDF['isCurrent'])
+    if LEADERBOARD_TOP_N > 0:
+        currentRank = grouped['currentRank'].transform('min')
+        lastRank = grouped['rank'].transform('max')
+        segmentDF['visible'] = ((segmentDF['rank'] <= LEADERBOARD_TOP_N)
+                                | ((segmentDF['rank'] - currentRank).abs() <= LEADERBOARD_NEIGHBOURS)
+                                | (segmentDF['rank'] == lastRank))
+    else:
+        segmentDF['visible'] = True
+    aggregates = grouped.agg(**{key: (key, 'mean') for key in INFO_KEYS + AVERAGE_KEYS},
+                             minDuration=('Duration', 'min'),
+                             maxDuration=('Duration', 'max'),
+                             firstAttempt=('start', 'min'),
+                             lastAttempt=('start', 'max'),
+                             hasHeartRate=('hasHeartRate', 'sum'),
+                             hasCadence=('hasCadence', 'sum'),
+                             hasPower=('hasPower', 'sum'),
+                             rank=('currentRank', 'min'),
+                             numVisible=('visible', 'sum'))
+    aggregates['numAttempts'] = segmentNamesAttempts.reindex(aggregates.index)
+    aggregates['firstAttempt'] = keysToDateTimes(aggregates['firstAttempt']).dt.date.to_numpy()
+    aggregates['lastAttempt'] = keysToDateTimes(aggregates['lastAttempt']).dt.date.to_numpy()
+
+    segmentDF['deltaDuration'] = segmentDF['Duration'] - minDuration
+    segmentDF['deltaPercent'] = 100 * segmentDF['deltaDuration'] / minDuration
+    # The lazy page builds its rows from the packed board, the row markup is only formatted for the full page
+    boardRecords = []
+    if not LAZY_RENDER:
+        visibleDF = segmentDF.loc[segmentDF['visible'], BOARD_KEYS + ['name', 'start']]
+        segmentFlags = aggregates[['numAttempts', 'hasPower', 'hasHeartRate', 'hasCadence']].reindex(visibleDF['name'])
+        boardRecords = pandas.DataFrame({'rank': visibleDF['rank'].to_numpy(),
+                                         'html': formatBoard(visibleDF, segmentFlags)}).to_dict('records')
+    visibleOffsets = np.concatenate(([0], np.cumsum(aggregates['numVisible'].to_numpy())))
+    offsets = np.concatenate(([0], np.cumsum(aggregates['numAttempts'].to_numpy())))
+    boardColumns = {key: segmentDF[key].to_numpy() for key in PACKED_KEYS}
+    visible = segmentDF['visible'].to_numpy()
+    current = segmentDF.loc[segmentDF['isCurrent'], ['name', 'start', 'Duration', 'trace']]
+    current = current.sort_index().drop_duplicates('name').set_index('name')
+    if PROGRESSION_CHART:
+        progressionColumns = findProgressions(segmentDF)
+
+    segments = []
+    for i, (name, aggregate) in enumerate(aggregates.to_dict('index').items()):
+        # A segment without attempt of the current activity cannot be ranked, it is left out
+        # instead of failing the whole page
+        if pandas.isna(aggregate['rank']) or name not in current.index:
+            print("No current attempt found for segment {}".format(name))
+            continue
+        attempts = int(aggregate['numAttempts'])
+        rank = int(aggregate['rank'])
+        deltaDuration = aggregate['maxDuration'] - aggregate['minDuration']
         segmentData = dict()
         segmentData['name'] = name
         segmentData['numAttempts'] = attempts
-        segmentData['hasHeartRate'] = ((segmentDF['Average_Heart_Rate'] > 0.0).sum())
-        segmentData['hasCadence'] = ((segmentDF['Average_Cadence'] > 0.0).sum())
-        segmentData['hasPower'] = ((segmentDF['Average_Power'] > 0.0).sum())
-        segmentData['rank'] = segmentBoardDF.index[segmentBoardDF['isCurrent']][0] + 1
-        segmentData['rankPercent'] = segmentData['rank'] / attempts * 100
-        segmentData['info'] = segmentInfoSeries.to_dict()
-        segmentData['averages'] = segmentAvgSeries.to_dict()
-        segmentData['attempts'] = segmentBoardDF.to_dict('records')
-        segmentData['firstAttempt'] = segmentDF['date'].min()
-        segmentData['lastAttempt'] = segmentDF['date'].max()
-        segmentData['deltaDuration'] = maxDuration - minDuration
-        segmentData['deltaPercent'] = 100 * (maxDuration - minDuration) / minDuration
-        segmentData['trace'] = current['trace']
-        segmentsDict[currentDateTime] = segmentData
-    od = OrderedDict(sorted(segmentsDict.items()))
-    return od.values()
-
-
-def collectData():
-    st = time.time()
-    trendIntervals, activity, activityIntervals, activityMetrics, activitySeason, info = retrieveData()
-    et1 = time.time()
-    matchingIntervalsDF, segmentNamesAttempts = prepareData(trendIntervals,
-                                                            activityIntervals,
-                                                            activityMetrics,
-                                                            activitySeason,
-                                                            activity)
-    et2 = time.time()
-    print("retrieveData took {:.3f} seconds".format(et1-st))
-    print("prepareData took {:.3f} seconds".format(et2-et1))
+        segmentData['hasHeartRate'] = aggregate['hasHeartRate']
+        segmentData['hasCadence'] = aggregate['hasCadence']
+        segmentData['hasPower'] = aggregate['hasPower']
+        segmentData['rank'] = rank
+        segmentData['rankPercent'] = rank / attempts * 100
+        segmentData['info'] = {key: aggregate[key] for key in INFO_KEYS}
+        segmentData['averages'] = {key: aggregate[key] for key in AVERAGE_KEYS}
+        segmentData['attempts'] = boardRecords[visibleOffsets[i]:visibleOffsets[i + 1]]
+        segmentData['board'] = {key: column[offsets[i]:offsets[i + 1]] for key, column in boardColumns.items()}
+        segmentData['visibleRanges'] = visibleRanges(visible[offsets[i]:offsets[i + 1]])
+        segmentData['firstAttempt'] = aggregate['firstAttempt']
+        segmentData['lastAttempt'] = aggregate['lastAttempt']
+        segmentData['deltaDuration'] = deltaDuration
+        segmentData['deltaPercent'] = 100 * deltaDuration / aggregate['minDuration']
+        segmentData['trace'] = current.at[name, 'trace']
+        segmentData['currentDuration'] = current.at[name, 'Duration']
+        segmentData['currentStart'] = current.at[name, 'start']
+        if PROGRESSION_CHART:
+            segmentData['progression'] = {key: column[offsets[i]:offsets[i + 1]]
+                                          for key, column in progressionColumns.items()}
+        segments.append((current.at[name, 'start'], segmentData))
+    segments.sort(key=lambda segment: segment[0])
+    return [segmentData for _, segmentData in segments]
+
+
+def formatBoard(boardDF, segmentFlags):
+    """
+    Format the leaderboard rows a column at a time and join them into the row markup,
+    the template only inserts the rows. Cells are formatted like the duration, show, round and int filters
+
+    :return: Array of the markup of each row
+    """
+    days, secs = np.divmod(boardDF['start'].to_numpy(), 86400)
+    uniqueDays, dayIndices = np.unique(days, return_inverse=True)
+    dates = np.array([date.fromordinal(int(d) + EPOCH_ORDINAL).strftime(DATE_FORMAT) for d in uniqueDays],
+                     dtype=object)[dayIndices]
+    hours, secs = np.divmod(secs, 3600)
+    mins, secs = np.divmod(secs, 60)
+    times = zeroPadded(hours) + ":" + zeroPadded(mins) + ":" + zeroPadded(secs)
+
+    numAttempts = segmentFlags['numAttempts'].to_numpy()
+    hasPower = segmentFlags['hasPower'].to_numpy() > 0
+    hasHeartRate = segmentFlags['hasHeartRate'].to_numpy() > 0
+    hasCadence = segmentFlags['hasCadence'].to_numpy() > 0
+    rank = boardDF['rank'].to_numpy()
+    power = boardDF['Average_Power'].to_numpy()
+
+    html = np.where(boardDF['isCurrent'].to_numpy(), '<tr class="table-primary">\n', '<tr>\n').astype(object)
+    html += '<th scope="row">' + rank.astype(str).astype(object) + '</th>\n'
+    html += '<td>' + dates + '</td>\n<td>' + times + '</td>\n'
+    html += '<td>' + formatDurations(boardDF['Duration'].to_numpy()) + '</td>\n'
+    delta = (formatDurations(boardDF['deltaDuration'].to_numpy()) + "\n ("
+             + formatRounded(boardDF['deltaPercent'].to_numpy(), 1) + "%)")
+    html += np.where(numAttempts > 1, '<td>' + np.where(rank > 1, delta, '') + '</td>', '')
+    html += np.where(hasPower, '<td>' + np.where(power > 0, formatRounded(power, 1), "-") + '</td>\n', '')
+    html += np.where(hasHeartRate, '<td>' + formatPositiveInts(boardDF['Average_Heart_Rate'].to_numpy()) + '</td>\n', '')
+    html += '<td>' + formatRounded(boardDF['Average_Speed'].to_numpy(), 2) + '</td>\n'
+    html += np.where(hasCadence, '<td>' + formatPositiveInts(boardDF['Average_Cadence'].to_numpy()) + '</td>\n', '')
+    html += np.where(hasPower, '<td>' + formatInts(boardDF['BikeStress'].to_numpy()) + '</td>\n', '')
+    html += '<td>' + formatInts(boardDF['VAM'].to_numpy()) + '</td>\n</tr>\n'
+    return html
+
+
+def zeroPadded(values):
+    return np.where(values < 10, "0", "").astype(object) + values.astype(str).astype(object)
+
+
+def formatDurations(values):
+    mins = (values / 60).astype(np.int64).astype(str).astype(object)
+    return mins + ":" + zeroPadded(np.fmod(values, 60).astype(np.int64))
+
 
+def formatInts(values):
+    return np.trunc(np.nan_to_num(values)).astype(np.int64).astype(str).astype(object)
+
+
+def formatPositiveInts(values):
+    values = np.trunc(np.nan_to_num(values))
+    return np.where(values > 0, formatInts(values), "-").astype(object)
+
+
+def formatRounded(values, digits):
+    # Python's round rounds the exact binary value, numpy's round does not always agree with it
+    return np.array([str(round(value, digits)) for value in values.tolist()], dtype=object)
+
+
+def findProgressions(segmentDF):
+    """
+    Compute the progression of all segments in one pass over their attempts in chronological order:
+    the running personal best and the mean duration of the attempts in the preceding PROGRESSION_WINDOW_DAYS
+
+    :return: Columns of start, Duration, best, mean and isCurrent, grouped by segment in the order of findSegments
+    """
+    progressionDF = segmentDF[['name', 'start', 'Duration', 'isCurrent']].sort_values(by=['name', 'start'],
+                                                                                     kind='stable')
+    starts = progressionDF['start'].to_numpy()
+    durations = progressionDF['Duration'].to_numpy()
+    best = progressionDF.groupby('name', sort=True, observed=True)['Duration'].cummin().to_numpy()
+
+    # Offset the keys of each segment further than the window so windows never reach into another segment
+    window = PROGRESSION_WINDOW_DAYS * 86400
+    span = starts.max(initial=0) - starts.min(initial=0) + window + 1
+    keys = progressionDF['name'].cat.codes.to_numpy().astype(np.int64) * span + starts
+    windowStarts = np.searchsorted(keys, keys - window, side='left')
+    sums = np.concatenate(([0], np.cumsum(durations)))
+    indices = np.arange(len(keys))
+    mean = (sums[indices + 1] - sums[windowStarts]) / (indices + 1 - windowStarts)
     return {
-        'overview': createSegmentsOverview(segmentNamesAttempts, activitySeason),
-        'data': findSegments(segmentNamesAttempts, matchingIntervalsDF)
+        'start': starts,
+        'Duration': durations,
+        'best': best,
+        'mean': mean,
+        'isCurrent': progressionDF['isCurrent'].to_numpy()
+    }
+
+
+def collectData(profiler, data):
+    trendIntervals, activity, activityIntervals, activityMetrics, activitySeason, info = data
+    with profiler.stage('prepareData') as stage:
+        matchingIntervalsDF, segmentNamesAttempts = prepareData(trendIntervals,
+                                                                activityIntervals,
+                                                                activityMetrics,
+                                                                activitySeason,
+                                                                activity)
+        stage['rows'] = len(matchingIntervalsDF)
+
+    with profiler.stage('findSegments') as stage:
+        segments = findSegments(segmentNamesAttempts, matchingIntervalsDF)
+        stage['rows'] = len(segments)
+    activityStart = datetime.combine(activityMetrics['date'], activityMetrics['time'])
+    if ALL_TIME_INDEX and not info['autoDetected']:
+        with profiler.stage('allTimeRanks'):
+            try:
+                addAllTimeRanks(segments, info['intervalType'], (activityStart, activityIntervals))
+            except Exception:
+                traceback.print_exc()
+
+    if BEST_COMPARISON:
+        with profiler.stage('bestComparisons'):
+            try:
+                addBestComparisons(segments, activity, activityStart, comparisonReferences())
+            except Exception:
+                traceback.print_exc()
+
+    if LAZY_RENDER or LEADERBOARD_TOP_N > 0:
+        with profiler.stage('packSegments'):
+            packSegments(segments)
+    if PROGRESSION_CHART:
+        with profiler.stage('packProgressions'):
+            packProgressions(segments)
+    if BEST_COMPARISON:
+        packComparisons(segments)
+
+    return {
+        'overview': createSegmentsOverview(segments, activitySeason),
+        'data': segments
     }, info
 
 
+def comparisonReferences():
+    """
+    Find the activities attempts to compare with can be taken from.
+    Slices of activities deleted or modified since they were taken are removed
+
+    :return: Activities, their start keys and the name prefixes of their attempt slices
+    """
+    activities = sorted(GC.activities())
+    modified = activitiesModified(activities)
+    prefixes = [slicePrefix(a, modified[a.isoformat()]) for a in activities]
+    pruneSlices(set(prefixes))
+    return activities, startKeys([a.date() for a in activities], [a.time() for a in activities]), prefixes
+
+
+def addBestComparisons(segments, activity, activityStart, references, seriesActivity=None):
+    """
+    Compare the current attempt of each segment with the fastest attempt of another activity,
+    other laps of the current activity are passed over.
+    Only the slice of the other attempt is taken from its activity and kept on disk,
+    both attempts are interpolated onto a common distance grid.
+    The distance series of the activity, given as GC.series activity argument, is only retrieved
+    once a segment has an attempt to compare with
+    """
+    seconds = np.asarray(activity['seconds'], dtype=float)
+    distance = None
+    activities, activityKeys, prefixes = references
+    currentKey = startKeys([activityStart.date()], [activityStart.time()])[0]
+    for segment in segments:
+        board = segment['board']
+        # The board is sorted by duration, the activity of each attempt is the last one started before it
+        owners = np.searchsorted(activityKeys, board['start'], side='right') - 1
+        others = np.flatnonzero((owners >= 0) & (activityKeys[np.maximum(owners, 0)] != currentKey))
+        if len(others) == 0:
+            continue
+        reference = others[0]
+        referenceKey = board['start'][reference]
+        i = owners[reference]
+        if distance is None:
+            distance = np.asarray(GC.series(GC.SERIES_KM, activity=seriesActivity), dtype=float)
+        current = seriesSlice(seconds, distance, segment['currentStart'] - currentKey, segment['currentDuration'])
+        best = attemptSlice(activities[i], prefixes[i], referenceKey - activityKeys[i], board['Duration'][reference])
+        if len(current) < 2 or len(best) < 2:
+            continue
+        grid = np.linspace(0, min(current[-1, 1], best[-1, 1]), BEST_COMPARISON_POINTS)
+        gap = (np.interp(grid, np.maximum.accumulate(current[:, 1]), current[:, 0])
+               - np.interp(grid, np.maximum.accumulate(best[:, 1]), best[:, 0]))
+        segment['comparison'] = {'distance': grid,
+                                 'gap': gap,
+                                 'reference': referenceKey,
+                                 'isPersonalBest': bool(segment['currentDuration'] < board['Duration'][reference])}
+
+
+def seriesSlice(seconds, distance, offset, duration):
+    """
+    :return: (n, 2) array of seconds and kilometers since the start of the attempt
+    """
+    istart, iend = np.searchsorted(seconds, [offset, offset + duration], side='left')
+    return np.column_stack((seconds[istart:iend + 1] - offset, distance[istart:iend + 1] - distance[istart]))
+
+
+def attemptSlice(activityStart, prefix, offset, duration):
+    """
+    Retrieve seconds and distance of an attempt of another activity,
+    attempt slices are kept on disk so each is only loaded once
+
+    :return: (n, 2) array of seconds and kilometers since the start of the attempt
+    """
+    path = slicesDir() / "{}_{}_{}.npy".format(prefix, int(offset), int(duration * 1000))
+    try:
+        return np.load(str(path))
+    except Exception:
+        pass
+    seconds, distance = activityDistanceSeries(activityStart)
+    attempt = seriesSlice(seconds, distance, offset, duration)
+    try:
+        np.save(str(path), attempt)
+    except Exception:
+        traceback.print_exc()
+    return attempt
+
+
+def slicesDir():
+    path = cacheDir() / 'slices'
+    path.mkdir(exist_ok=True)
+    return path
+
+
+def slicePrefix(activityStart, modified):
+    """
+    :return: Name prefix of the attempt slices of an activity, changes with the modification time of the activity
+    """
+    return "{}_{}".format(activityStart.strftime("%Y%m%d_%H%M%S"), modified)
+
+
+def pruneSlices(prefixes):
+    """
+    Remove the attempt slices of activities that were deleted or modified since the slices were taken
+    """
+    for path in slicesDir().glob("*.npy"):
+        if path.stem.rsplit('_', 2)[0] not in prefixes:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
+@functools.lru_cache(maxsize=8)
+def activityDistanceSeries(activityStart):
+    return (np.asarray(GC.series(GC.SERIES_SECS, activity=activityStart), dtype=float),
+            np.asarray(GC.series(GC.SERIES_KM, activity=activityStart), dtype=float))
+
+
+def packSegments(segments):
+    """
+    Pack the leaderboard and trace of each segment as a compact JavaScript literal.
+    The page builds tables, maps and further leaderboard pages from it on demand
+    """
+    for segment in segments:
+        packed = {'numAttempts': int(segment['numAttempts']),
+                  'hasPower': bool(segment['hasPower']),
+                  'hasHeartRate': bool(segment['hasHeartRate']),
+                  'hasCadence': bool(segment['hasCadence']),
+                  'visibleRanges': segment['visibleRanges'],
+                  'board': {key: column.tolist() for key, column in segment['board'].items()}}
+        if LAZY_RENDER:
+            packed['trace'] = np.round(np.asarray(segment['trace'], dtype=float), 6).tolist()
+        segment['packed'] = json.dumps(packed, separators=(',', ':'))
+
+
+def packProgressions(segments):
+    """
+    Pack the progression of each segment as a compact JavaScript literal, durations in tenths of a second
+    """
+    for segment in segments:
+        progression = segment['progression']
+        packed = {'start': progression['start'].tolist(),
+                  'current': np.flatnonzero(progression['isCurrent']).tolist()}
+        for key in ['Duration', 'best', 'mean']:
+            packed[key] = np.round(progression[key], 1).tolist()
+        segment['packedProgression'] = json.dumps(packed, separators=(',', ':'))
+
+
+def packComparisons(segments):
+    """
+    Pack the comparison of each segment as a compact JavaScript literal, gaps in tenths of a second
+    """
+    for segment in segments:
+        if 'comparison' not in segment:
+            continue
+        comparison = segment['comparison']
+        segment['packedComparison'] = json.dumps({'distance': np.round(comparison['distance'], 3).tolist(),
+                                                  'gap': np.round(comparison['gap'], 1).tolist(),
+                                                  'reference': int(comparison['reference']),
+                                                  'isPersonalBest': comparison['isPersonalBest']},
+                                                 separators=(',', ':'))
+
+
 def multilineStrip(ml):
     r = ""
     for line in ml.splitlines():
@@ -387,6 +1705,10 @@ def getDefaultTemplate():
           div.map {
             height: 200px;
           }
+          svg.progression {
+            width: 100%;
+            height: 200px;
+          }
           .tableFixHead {
             overflow: auto;
             height: 100px;
@@ -404,7 +1726,7 @@ def getDefaultTemplate():
           {%- if info.Route | length > 0 -%}{{ info.Route }}{%- else %}Activity{%- endif %}
           ({{ info.date | format_date }})
         </h1>
-        <h2>Found {{ segments.overview.numSegments }} route
+        <h2>Found {{ segments.overview.numSegments }} {{ 'detected' if info.autoDetected else 'route' }}
           {%- if segments.overview.numSegments == 1 -%}segment{%- else %}segments{%- endif %}
           in season <em>{{ info.seasonName}}</em>
           {%- if info.outOfSeason -%}<small class="text-muted">Activity is out of season</small>{%- endif -%}
@@ -478,6 +1800,21 @@ def getDefaultTemplate():
                             <td>{{ segment.deltaDuration | duration }} ({{ segment.deltaPercent | round(1) }}%)</td>
                           </tr>
                           {% endif %}
+                          {% if segment.allTimeAttempts %}
+                          <tr>
+                            <th scope="row">All-time rank</th>
+                            <td>{{ segment.allTimeRank }} / {{ segment.allTimeAttempts }}</td>
+                          </tr>
+                          <tr>
+                            <th scope="row">All-time best</th>
+                            <td>
+                            {%- for attempt in segment.allTimeTop -%}
+                              {{ attempt.Duration | duration }} ({{ attempt.start | format_date }})
+                              {%- if not loop.last %}, {% endif -%}
+                            {%- endfor -%}
+                            </td>
+                          </tr>
+                          {% endif %}
                         </tbody>
                       </table>
                     </div>
@@ -524,6 +1861,14 @@ def getDefaultTemplate():
                     {% endif %}
                   </div>
                 </div>
+                {% if progression %}
+                <h5>Progression</h5>
+                <div id="progression{{ loop.index }}"></div>
+                {% endif %}
+                {% if segment.packedComparison %}
+                <h5>Gap to best attempt</h5>
+                <div id="comparison{{ loop.index }}"></div>
+                {% endif %}
                 <h5>Leaderboard</h5>
                 <table class="table table-sm table-striped tableFixHead">
                   <thead>
@@ -551,41 +1896,32 @@ def getDefaultTemplate():
                       <th scope="col">VAM</th>
                     </tr>
                   </thead>
+                  {% if lazy %}
+                  <tbody id="board{{ loop.index }}"></tbody>
+                  {% else %}
                   <tbody>
+                  {% set segmentIdx = loop.index %}
+                  {% set board = namespace(lastRank=0) %}
                   {% for attempt in segment.attempts %}
-                    {%if attempt.isCurrent %}
-                    <tr class="table-primary">
-                    {% else %}
-                    <tr>
+                    {% if attempt.rank > board.lastRank + 1 %}
+                    {% set hidden = attempt.rank - 1 - board.lastRank %}
+                    <tr><td colspan="11">
+                      <button type="button"
+                              class="btn btn-sm btn-link"
+                              onclick="showMore(this, {{ segmentIdx }}, {{ board.lastRank }}, {{ attempt.rank - 1 }});">
+                        Show {{ [hidden, """ + str(LEADERBOARD_PAGE_SIZE) + """] | min }} of {{ hidden }} more
+                      </button>
+                    </td></tr>
                     {% endif %}
-                      <th scope="row">{{ loop.index }}</th>
-                      <td>{{ attempt.date | format_date }}</td>
-                      <td>{{ attempt.time }}</td>
-                      <td>{{ attempt.Duration | duration }}</td>
-                      {% if segment.numAttempts > 1 -%}
-                      <td>{%- if loop.index > 1 -%}{{ attempt.deltaDuration | duration }}
-                      ({{ attempt.deltaPercent | round(1) }}%){%- endif -%}</td>
-                      {%- endif %}
-                      {% if segment.hasPower %}
-                      <td>{{ attempt.Average_Power | show }}</td>
-                      {% endif %}
-                      {% if segment.hasHeartRate %}
-                      <td>{{ attempt.Average_Heart_Rate | int | show }}</td>
-                      {% endif %}
-                      <td>{{ attempt.Average_Speed | round(2) }}</td>
-                      {% if segment.hasCadence %}
-                      <td>{{ attempt.Average_Cadence | int | show }}</td>
-                      {% endif %}
-                      {% if segment.hasPower %}
-                      <td>{{ attempt.BikeStress | int }}</td>
-                      {% endif %}
-                      <td>{{ attempt.VAM | int }}</td>
-                    </tr>
+                    {% set board.lastRank = attempt.rank %}
+                    {{- attempt.html -}}
                   {% endfor %}
                   </tbody>
+                  {% endif %}
                 </table>
               </div>
             </div>
+            {% if not lazy %}
             <script>
               var acc = document.getElementById('collapse{{ loop.index }}')
               acc.addEventListener('shown.bs.collapse', function (event) {
@@ -611,6 +1947,7 @@ def getDefaultTemplate():
                 map.invalidateSize(true);
               })
             </script>
+            {% endif %}
           </div>
         {% endfor %}
         </div>
@@ -629,6 +1966,233 @@ def getDefaultTemplate():
             iconAnchor: [8, 8]});
           {% endfor %}
         </script>
+        {% if packed or progression or comparison %}
+        <script type="text/javascript">
+          function pad(value) {
+            return String(value).padStart(2, "0");
+          }
+          function strftime(key, format) {
+            var when = new Date(key * 1000);
+            var fields = {
+              d: pad(when.getUTCDate()),
+              m: pad(when.getUTCMonth() + 1),
+              Y: when.getUTCFullYear(),
+              H: pad(when.getUTCHours()),
+              M: pad(when.getUTCMinutes()),
+              S: pad(when.getUTCSeconds())
+            };
+            return format.replace(/%([dmYHMS])/g, (match, field) => fields[field]);
+          }
+          function duration(value) {
+            var mins = Math.trunc(value / 60);
+            var secs = Math.trunc(value % 60);
+            return mins + ":" + pad(secs);
+          }
+          function round(value, digits) {
+            var factor = Math.pow(10, digits);
+            var rounded = Math.round(value * factor) / factor;
+            return Number.isInteger(rounded) ? rounded.toFixed(1) : String(rounded);
+          }
+        </script>
+        {% endif %}
+        {% if packed %}
+        <script type="text/javascript">
+          const segments = [
+          {%- for segment in segments.data -%}
+            {{ segment.packed }},
+          {%- endfor -%}
+          ];
+          const pageSize = """ + str(LEADERBOARD_PAGE_SIZE) + """;
+          function int(value) {
+            return isNaN(value) ? 0 : Math.trunc(value);
+          }
+          function show(value) {
+            return value > 0 ? value : "-";
+          }
+          function renderRows(segment, from, to) {
+            var board = segment.board;
+            var rows = '';
+            for (var i = from; i < to; i++) {
+              rows += board.isCurrent[i] ? '<tr class="table-primary">' : '<tr>';
+              rows += '<th scope="row">' + (i + 1) + '</th>'
+                    + '<td>' + strftime(board.start[i], '""" + DATE_FORMAT + """') + '</td>'
+                    + '<td>' + strftime(board.start[i], '%H:%M:%S') + '</td>'
+                    + '<td>' + duration(board.Duration[i]) + '</td>';
+              if (segment.numAttempts > 1) {
+                rows += '<td>'
+                      + (i > 0 ? duration(board.deltaDuration[i]) + ' (' + round(board.deltaPercent[i], 1) + '%)' : '')
+                      + '</td>';
+              }
+              if (segment.hasPower) {
+                rows += '<td>' + (board.Average_Power[i] > 0 ? round(board.Average_Power[i], 1) : '-') + '</td>';
+              }
+              if (segment.hasHeartRate) {
+                rows += '<td>' + show(int(board.Average_Heart_Rate[i])) + '</td>';
+              }
+              rows += '<td>' + round(board.Average_Speed[i], 2) + '</td>';
+              if (segment.hasCadence) {
+                rows += '<td>' + show(int(board.Average_Cadence[i])) + '</td>';
+              }
+              if (segment.hasPower) {
+                rows += '<td>' + int(board.BikeStress[i]) + '</td>';
+              }
+              rows += '<td>' + int(board.VAM[i]) + '</td></tr>';
+            }
+            return rows;
+          }
+          function gapRow(idx, from, to) {
+            return '<tr><td colspan="11">'
+                 + '<button type="button" class="btn btn-sm btn-link" '
+                 + 'onclick="showMore(this, ' + idx + ', ' + from + ', ' + to + ');">'
+                 + 'Show ' + Math.min(to - from, pageSize) + ' of ' + (to - from) + ' more'
+                 + '</button></td></tr>';
+          }
+          function showMore(button, idx, from, to) {
+            var until = Math.min(to, from + pageSize);
+            var rows = renderRows(segments[idx - 1], from, until);
+            if (until < to) {
+              rows += gapRow(idx, until, to);
+            }
+            var row = button.closest('tr');
+            row.insertAdjacentHTML('beforebegin', rows);
+            row.remove();
+          }
+        </script>
+        {% endif %}
+        {% if lazy %}
+        <script type="text/javascript">
+          function renderBoard(idx, segment) {
+            var rows = '';
+            var last = 0;
+            segment.visibleRanges.forEach((range) => {
+              if (range[0] > last) {
+                rows += gapRow(idx, last, range[0]);
+              }
+              rows += renderRows(segment, range[0], range[1]);
+              last = range[1];
+            });
+            return rows;
+          }
+          function renderMap(idx, segment) {
+            var map = L.map('map' + idx, {
+              scrollWheelZoom: false,
+              maxZoom: """ + MAP_MAX_ZOOM + """
+            });
+            L.tileLayer('""" + MAP_PROVIDER + """', {
+                attribution: '""" + MAP_ATTRIBUTION + """'
+            }).addTo(map);
+            var latlngs = segment.trace;
+            var polyline = L.polyline(latlngs, {color: '""" + TRACE_COLOR + """'}).addTo(map);
+            var markerStart = L.marker(latlngs[0], {icon: greenMarker}).addTo(map);
+            var markerFinish = L.marker(latlngs[latlngs.length - 1], {icon: redMarker}).addTo(map);
+            var group = new L.featureGroup([polyline, markerStart, markerFinish]);
+            map.fitBounds(group.getBounds());
+            map.invalidateSize(true);
+          }
+          document.getElementById('accordionSegments').addEventListener('shown.bs.collapse', function (event) {
+            var idx = parseInt(event.target.id.substring('collapse'.length));
+            var segment = segments[idx - 1];
+            if (segment.rendered) {
+              return;
+            }
+            segment.rendered = true;
+            document.getElementById('board' + idx).innerHTML = renderBoard(idx, segment);
+            renderMap(idx, segment);
+          });
+        </script>
+        {% endif %}
+        {% if progression %}
+        <script type="text/javascript">
+          const progressions = [
+          {%- for segment in segments.data -%}
+            {{ segment.packedProgression }},
+          {%- endfor -%}
+          ];
+          function renderProgression(progression) {
+            var width = 600, height = 200, left = 50, right = 10, top = 10, bottom = 25;
+            var n = progression.start.length;
+            var first = progression.start[0], last = progression.start[n - 1];
+            var low = Math.min(...progression.Duration), high = Math.max(...progression.Duration);
+            var x = (i) => left + (last > first ? (progression.start[i] - first) / (last - first) : 0.5)
+                                * (width - left - right);
+            var y = (value) => top + (high > low ? (high - value) / (high - low) : 0.5) * (height - top - bottom);
+            var best = '', mean = '', attempts = '';
+            for (var i = 0; i < n; i++) {
+              best += (i > 0 ? x(i) + ',' + y(progression.best[i - 1]) + ' ' : '') + x(i) + ',' + y(progression.best[i]) + ' ';
+              mean += x(i) + ',' + y(progression.mean[i]) + ' ';
+              attempts += '<circle cx="' + x(i) + '" cy="' + y(progression.Duration[i]) + '" r="3" fill="#6c757d" />';
+            }
+            progression.current.forEach((i) => {
+              attempts += '<circle cx="' + x(i) + '" cy="' + y(progression.Duration[i]) + '" r="5" fill="#0d6efd" />';
+            });
+            return '<svg class="progression" viewBox="0 0 ' + width + ' ' + height + '" '
+                 + 'xmlns="http://www.w3.org/2000/svg" font-size="11">'
+                 + '<polyline points="' + mean + '" fill="none" stroke="#adb5bd" stroke-width="2" />'
+                 + '<polyline points="' + best + '" fill="none" stroke=""" + '"' + TRACE_COLOR + '"' + """ stroke-width="2" />'
+                 + attempts
+                 + '<text x="' + (left - 5) + '" y="' + (top + 4) + '" text-anchor="end">' + duration(high) + '</text>'
+                 + '<text x="' + (left - 5) + '" y="' + (height - bottom) + '" text-anchor="end">' + duration(low) + '</text>'
+                 + '<text x="' + left + '" y="' + (height - 5) + '">' + strftime(first, '""" + DATE_FORMAT + """') + '</text>'
+                 + '<text x="' + (width - right) + '" y="' + (height - 5) + '" text-anchor="end">'
+                 + strftime(last, '""" + DATE_FORMAT + """') + '</text>'
+                 + '<text x="' + (width / 2) + '" y="' + (height - 5) + '" text-anchor="middle">'
+                 + 'personal best (""" + TRACE_COLOR + """), """ + str(PROGRESSION_WINDOW_DAYS) + """ day mean (grey)</text>'
+                 + '</svg>';
+          }
+          document.getElementById('accordionSegments').addEventListener('shown.bs.collapse', function (event) {
+            var idx = parseInt(event.target.id.substring('collapse'.length));
+            var container = document.getElementById('progression' + idx);
+            if (container.childElementCount == 0) {
+              container.innerHTML = renderProgression(progressions[idx - 1]);
+            }
+          });
+        </script>
+        {% endif %}
+        {% if comparison %}
+        <script type="text/javascript">
+          const comparisons = [
+          {%- for segment in segments.data -%}
+            {{ segment.packedComparison | default('null') }},
+          {%- endfor -%}
+          ];
+          function signedDuration(value) {
+            return (value < 0 ? "-" : "+") + duration(Math.abs(value));
+          }
+          function renderComparison(comparison) {
+            var width = 600, height = 200, left = 50, right = 10, top = 10, bottom = 25;
+            var n = comparison.distance.length;
+            var length = comparison.distance[n - 1];
+            var low = Math.min(0, ...comparison.gap), high = Math.max(0, ...comparison.gap);
+            var x = (value) => left + (length > 0 ? value / length : 0.5) * (width - left - right);
+            var y = (value) => top + (high > low ? (high - value) / (high - low) : 0.5) * (height - top - bottom);
+            var gap = '';
+            for (var i = 0; i < n; i++) {
+              gap += x(comparison.distance[i]) + ',' + y(comparison.gap[i]) + ' ';
+            }
+            return '<svg class="progression" viewBox="0 0 ' + width + ' ' + height + '" '
+                 + 'xmlns="http://www.w3.org/2000/svg" font-size="11">'
+                 + '<line x1="' + left + '" y1="' + y(0) + '" x2="' + (width - right) + '" y2="' + y(0) + '" '
+                 + 'stroke="#adb5bd" />'
+                 + '<polyline points="' + gap + '" fill="none" stroke=""" + '"' + TRACE_COLOR + '"' + """ stroke-width="2" />'
+                 + '<text x="' + (left - 5) + '" y="' + (top + 4) + '" text-anchor="end">' + signedDuration(high) + '</text>'
+                 + '<text x="' + (left - 5) + '" y="' + (height - bottom) + '" text-anchor="end">' + signedDuration(low) + '</text>'
+                 + '<text x="' + left + '" y="' + (height - 5) + '">0 km</text>'
+                 + '<text x="' + (width - right) + '" y="' + (height - 5) + '" text-anchor="end">'
+                 + round(length, 2) + ' km</text>'
+                 + '<text x="' + (width / 2) + '" y="' + (height - 5) + '" text-anchor="middle">'
+                 + (comparison.isPersonalBest ? 'Lead on the next best attempt' : 'Behind the best attempt')
+                 + ' of ' + strftime(comparison.reference, '""" + DATE_FORMAT + """') + '</text>'
+                 + '</svg>';
+          }
+          document.getElementById('accordionSegments').addEventListener('shown.bs.collapse', function (event) {
+            var idx = parseInt(event.target.id.substring('collapse'.length));
+            var container = document.getElementById('comparison' + idx);
+            if (container && container.childElementCount == 0 && comparisons[idx - 1]) {
+              container.innerHTML = renderComparison(comparisons[idx - 1]);
+            }
+          });
+        </script>
+        {% endif %}
       </body>
     </html>""")
 
@@ -1,7 +1,9 @@
-import math
+import json
+import os
 import time
 import pathlib
 import tempfile
+import numpy as np
 from jinja2.filters import pass_environment
 from jinja2 import Environment
 from datetime import date, datetime
@@ -14,6 +16,13 @@ DATE_FORMAT = "%d.%m.%Y"
 
 HIGH_SPEED_ABS = 70
 HIGH_SPEED_REL = 50
+# Passing events are placed on the track by their XDATA timestamp, events further than this many seconds away
+# from a GPS fix are left out
+RADAR_MAX_GAP = 10
+# Keep the passing events of every activity, the trends chart only extracts activities that changed since
+RADAR_CACHE = True
+CACHE_DIR = "goldencharts"
+RADAR_CACHE_FILE = "radar_events.json"
 
 MAP_URL = "https://tile.openstreetmap.org/{z}/{x}/{y}.png"
 
@@ -263,6 +272,117 @@ def getEmptyTemplate():
     </html>""")
 
 
+def readRadarEvents(activity):
+    """
+    Read the passing events of the radar with the timestamps of the XDATA samples. XDATA is recorded on its own
+    clock, so all events are placed on the track at once by interpolating between the GPS fixes around them
+
+    :return: Tuple of arrays with latitude, longitude, relative speed, absolute speed and seconds of the events
+             and the track as list of latitude and longitude
+    """
+    secs = np.asarray(GC.series(GC.SERIES_SECS, activity=activity), dtype=float)
+    lats = np.asarray(GC.series(GC.SERIES_LAT, activity=activity), dtype=float)
+    lons = np.asarray(GC.series(GC.SERIES_LON, activity=activity), dtype=float)
+    radarSecs = np.asarray(GC.xdataSeries("DEVELOPER", "secs", activity=activity), dtype=float)
+    radarCurrent = np.asarray(GC.xdataSeries("DEVELOPER", "radar_current", activity=activity), dtype=float)
+    radarPassingSpeed = np.asarray(GC.xdataSeries("DEVELOPER", "passing_speed", activity=activity), dtype=float)
+    radarPassingSpeedAbs = np.asarray(GC.xdataSeries("DEVELOPER", "passing_speedabs", activity=activity),
+                                      dtype=float)
+
+    maxI = min(len(secs), len(lats), len(lons))
+    # Samples without GPS fix have both coordinates at 0
+    fixes = (lats[:maxI] != 0) | (lons[:maxI] != 0)
+    secs = secs[:maxI][fixes]
+    lats = lats[:maxI][fixes]
+    lons = lons[:maxI][fixes]
+    track = np.column_stack((lats, lons)).tolist()
+
+    maxJ = min(len(radarSecs), len(radarCurrent), len(radarPassingSpeed), len(radarPassingSpeedAbs))
+    # A vehicle passed at sample j when the radar counter at j + 1 exceeds the counter of the last vehicle,
+    # which is the largest counter before, cut to an integer
+    counters = radarCurrent[1:maxJ]
+    lastCounters = np.trunc(np.fmax.accumulate(np.concatenate(([0.0], counters)))[:-1])
+    passings = np.flatnonzero(counters > lastCounters)
+    if len(secs) == 0:
+        passings = passings[:0]
+        return (radarSecs[passings],) * 5 + (track,)
+    # Events further than RADAR_MAX_GAP seconds away from a GPS fix cannot be placed
+    after = np.minimum(np.searchsorted(secs, radarSecs[passings]), len(secs) - 1)
+    before = np.maximum(after - 1, 0)
+    gap = np.minimum(np.abs(radarSecs[passings] - secs[before]), np.abs(radarSecs[passings] - secs[after]))
+    passings = passings[gap <= RADAR_MAX_GAP]
+    eventSecs = radarSecs[passings]
+    return (np.interp(eventSecs, secs, lats),
+            np.interp(eventSecs, secs, lons),
+            radarPassingSpeed[passings],
+            radarPassingSpeedAbs[passings],
+            eventSecs,
+            track)
+
+
+def cacheDir():
+    path = pathlib.Path(GC.athlete()['home']) / 'cache' / CACHE_DIR
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def activityStartTime(activity):
+    if activity is None:
+        metrics = GC.activityMetrics()
+        return datetime.combine(metrics['date'], metrics['time'])
+    return activity
+
+
+def activityModified(activityStart):
+    """
+    Modification time of the file GoldenCheetah keeps an activity in
+
+    :return: Modification time in nanoseconds, None if the file cannot be found
+    """
+    path = pathlib.Path(GC.athlete()['home']) / 'activities' / activityStart.strftime("%Y_%m_%d_%H_%M_%S.json")
+    try:
+        return path.stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+def loadEventStore(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def saveEventStore(path, store):
+    try:
+        with open(str(path) + ".tmp", "w") as f:
+            json.dump(store, f)
+        os.replace(str(path) + ".tmp", path)
+    except IOError:
+        print("Cannot write radar event store '%s'" % path)
+
+
+def storeRadarEvents(store, activityStart, events):
+    """
+    Store the passing events of an activity with the modification time of the activity and the settings the
+    events were extracted with. Activities without file are not stored, since they cannot be checked for changes
+
+    :return: True if the events were stored, False if the store already held them or the activity has no file
+    """
+    modified = activityModified(activityStart)
+    if modified is None:
+        return False
+    entry = {'modified': modified,
+             'settings': [RADAR_MAX_GAP],
+             'events': [column.tolist() for column in events]}
+    # Compared as JSON, since NaN in the events never equals itself
+    if json.dumps(store.get(activityStart.isoformat())) == json.dumps(entry):
+        return False
+    store[activityStart.isoformat()] = entry
+    return True
+
+
 def getActivityVehicles(activity):
     vehicles = []
     track = []
@@ -281,49 +401,30 @@ def getActivityVehicles(activity):
     }
 
     try:
-        lats = GC.series(GC.SERIES_LAT, activity=activity)
-        lons = GC.series(GC.SERIES_LON, activity=activity)
-        radarCurrent = GC.xdata("DEVELOPER", "radar_current", activity=activity)
-        radarPassingSpeed = GC.xdata("DEVELOPER", "passing_speed", activity=activity)
-        radarPassingSpeedAbs = GC.xdata("DEVELOPER", "passing_speedabs", activity=activity)
-
-        lens = [len(lats),
-                len(lons),
-                len(radarCurrent),
-                len(radarPassingSpeed),
-                len(radarPassingSpeedAbs)]
-        maxI = min(lens)
-
-        lastCurrent = 0
-        vehicleCount = 0
-        for i in range(maxI):
-            lat = lats[i]
-            lon = lons[i]
-            if math.isclose(lat, 0) and math.isclose(lon, 0):
-                continue
-            track.append([lat, lon])
-            if i < maxI - 1 and lastCurrent < radarCurrent[i + 1]:
-                vehicles.append([lat, lon, radarPassingSpeed[i], radarPassingSpeedAbs[i]])
-                lastCurrent = int(radarCurrent[i + 1])
-                vehicleCount += 1
-                if radarPassingSpeedAbs[i] >= HIGH_SPEED_ABS:
-                    stats['countFastAbs'] += 1
-                else:
-                    stats['countModerateAbs'] += 1
-                if radarPassingSpeed[i] >= HIGH_SPEED_REL:
-                    stats['countFastRel'] += 1
-                else:
-                    stats['countModerateRel'] += 1
-                stats['averageAbs'] += radarPassingSpeedAbs[i]
-                stats['averageRel'] += radarPassingSpeed[i]
-                stats['lowestAbs'] = min(radarPassingSpeedAbs[i], stats['lowestAbs'])
-                stats['lowestRel'] = min(radarPassingSpeed[i], stats['lowestRel'])
-                stats['highestAbs'] = max(radarPassingSpeedAbs[i], stats['highestAbs'])
-                stats['highestRel'] = max(radarPassingSpeed[i], stats['highestRel'])
-        stats['count'] = vehicleCount
+        events = readRadarEvents(activity)
+        (vehicleLats, vehicleLons, passingSpeeds, passingSpeedsAbs, _, track) = events
+        if RADAR_CACHE:
+            # Keep the events for the trends chart, so it does not need to extract this activity again
+            eventStorePath = cacheDir() / RADAR_CACHE_FILE
+            eventStore = loadEventStore(eventStorePath)
+            if storeRadarEvents(eventStore, activityStartTime(activity), events[:5]):
+                saveEventStore(eventStorePath, eventStore)
+        vehicles = np.column_stack((vehicleLats, vehicleLons, passingSpeeds, passingSpeedsAbs)).tolist()
+
+        vehicleCount = len(vehicles)
+        stats['countFastAbs'] = int(np.count_nonzero(passingSpeedsAbs >= HIGH_SPEED_ABS))
+        stats['countModerateAbs'] = vehicleCount - stats['countFastAbs']
+        stats['countFastRel'] = int(np.count_nonzero(passingSpeeds >= HIGH_SPEED_REL))
+        stats['countModerateRel'] = vehicleCount - stats['countFastRel']
         if vehicleCount > 0:
-            stats['averageAbs'] /= vehicleCount
-            stats['averageRel'] /= vehicleCount
+            # cumsum adds the speeds one after the other, so the averages do not change with the summation order
+            stats['averageAbs'] = float(np.cumsum(passingSpeedsAbs)[-1]) / vehicleCount
+            stats['averageRel'] = float(np.cumsum(passingSpeeds)[-1]) / vehicleCount
+            stats['lowestAbs'] = min(float(passingSpeedsAbs.min()), stats['lowestAbs'])
+            stats['lowestRel'] = min(float(passingSpeeds.min()), stats['lowestRel'])
+            stats['highestAbs'] = max(float(passingSpeedsAbs.max()), stats['highestAbs'])
+            stats['highestRel'] = max(float(passingSpeeds.max()), stats['highestRel'])
+        stats['count'] = vehicleCount
     finally:
         if stats['count'] == 0:
             stats['lowestAbs'] = 0